@@ -136,6 +136,19 @@ async def get_transcript_stats(commons: Dict[str, Any] = Depends(params_helper.c
     """
     return annotations_service.get_transcript_stats_summary(commons, payload)
 
+@router.get("/annotations/stats-summary")
+@router.post("/annotations/stats-summary")
+async def get_stats_summary_bundle(commons: Dict[str, Any] = Depends(params_helper.common_params), payload: Optional[Dict[str, Any]] = Body(None)):
+    """
+    Get the gene and transcript stats summaries of the queried annotations in a single request.
+    
+    Returns:
+    - total_annotations: Total number of annotations in queryset
+    - genes: Same payload as /annotations/gene-stats
+    - transcripts: Same payload as /annotations/transcript-stats
+    """
+    return annotations_service.get_stats_summary_bundle(commons, payload)
+
 @router.get("/annotations/transcript-stats/{type}")
 @router.post("/annotations/transcript-stats/{type}")
 async def get_transcript_type_details(type: str, commons: Dict[str, Any] = Depends(params_helper.common_params), payload: Optional[Dict[str, Any]] = Body(None)):
@@ -196,7 +209,7 @@ async def update_annotation_stats(md5_checksum: str, payload: Optional[Dict[str,
     return {"message": "Annotation stats updated"}
 
 @router.get("/annotations/{md5_checksum}/gff")
-async def stream_annotation_gff(md5_checksum: str, commons: Dict[str, Any] = Depends(params_helper.common_params)):
+def stream_annotation_gff(md5_checksum: str, commons: Dict[str, Any] = Depends(params_helper.common_params)):
     """
     Get GFF of an annotation file
     """
@@ -206,7 +219,7 @@ async def stream_annotation_gff(md5_checksum: str, commons: Dict[str, Any] = Dep
 
 
 @router.get("/annotations/{md5_checksum}/contigs")
-async def get_contigs(md5_checksum: str):
+def get_contigs(md5_checksum: str):
     """
     Get contigs of an annotation file, as in pysam.contigs(). Returns a stream of contigs
     """
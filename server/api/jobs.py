@@ -30,6 +30,15 @@ async def trigger_update_taxonomy_stats(x_auth_key: str = Header(..., alias="X-A
     """
     return jobs_service.trigger_update_taxonomy_stats(x_auth_key)
 
+@router.post("/jobs/update/features/stats")
+async def trigger_update_feature_stats(x_auth_key: str = Header(..., alias="X-Auth-Key")):
+    """
+    Trigger the features statistics backfill job
+    
+    Requires X-Auth-Key header for authentication.
+    """
+    return jobs_service.trigger_update_feature_stats(x_auth_key)
+
 @router.post("/jobs/update/assemblies")
 async def trigger_update_assemblies(x_auth_key: str = Header(..., alias="X-Auth-Key")):
     """
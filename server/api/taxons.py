@@ -33,7 +33,7 @@ async def get_taxons(commons: CommonQueryParams = Depends(), payload: Optional[d
     return taxonomy_service.get_taxon_nodes(**params)
     
 @router.get("/taxons/flattened-tree")
-async def get_flattened_tree(format: str = "json"):
+def get_flattened_tree(format: str = "json"):
     """Return flattened taxonomy tree. format: 'json' (default) or 'tsv'."""
     if format and format.lower() not in ("json", "tsv"):
         raise HTTPException(status_code=400, detail="format must be 'json' or 'tsv'")
@@ -41,7 +41,7 @@ async def get_flattened_tree(format: str = "json"):
 
 @router.get("/taxons/{taxid}")
 async def get_taxon(taxid: str):
-    return taxonomy_service.get_taxon_node(taxid).to_mongo().to_dict()
+    return taxonomy_service.get_taxon_node(taxid)
 
 @router.get("/taxons/frequencies/rank")
 async def get_rank_frequencies():
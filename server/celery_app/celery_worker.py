@@ -1,9 +1,18 @@
+from celery.signals import worker_ready
 from .celery_utils import create_celery
-from db.database import connect_to_db
+from db.database import connect_to_db, ensure_indexes
 from jobs.import_annotations import import_annotations
-from jobs.updates import update_taxon_stats, update_records
+from jobs.updates import update_taxon_stats, update_db_stats, update_records, update_feature_stats, compute_features_statistics_batch, backfill_taxon_parents, seed_taxon_rank_aggregates
 from jobs.track_users import track_unique_users_by_country
 
 app = create_celery()
 
 connect_to_db()
+
+@worker_ready.connect
+def on_worker_ready(**kwargs):
+    # declared indexes are created once per worker start instead of in each API process
+    ensure_indexes()
+    # one-off data migrations run as tasks on the worker, never in the API processes
+    backfill_taxon_parents.delay()
+    seed_taxon_rank_aggregates.delay()
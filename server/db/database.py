@@ -15,6 +15,25 @@ def connect_to_db():
     )
     logging.info("Successfully connected to MongoDB.")
 
+def ensure_indexes():
+    """Create the indexes declared on the models, existing indexes are left untouched."""
+    from db import models
+    for model in (
+        models.GenomeAssembly,
+        models.UserAnalytics,
+        models.BioProject,
+        models.Organism,
+        models.AnnotationSequenceMap,
+        models.GenomicSequence,
+        models.AnnotationError,
+        models.GenomeAnnotation,
+        models.TaxonNode,
+        models.TaxonRankAggregate,
+        models.TaxonTreeVersion,
+    ):
+        model.ensure_indexes()
+    logging.info("MongoDB indexes ensured.")
+
 def close_db_connection():
     """Close MongoDB connection."""
     logging.info("Closing MongoDB connection...")
@@ -145,6 +145,7 @@ class GFFStats(DynamicEmbeddedDocument):
     #new fields
     gene_category_stats = DictField(field=EmbeddedDocumentField(GeneCategoryFeatureStats))
     transcript_type_stats = DictField(field=EmbeddedDocumentField(GenericTranscriptTypeStats))
+    schema_version = IntField() #version of the stats computation, bumped when the parsing logic changes
 
 
 class DistributionStats(EmbeddedDocument):
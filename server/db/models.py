@@ -6,6 +6,7 @@ from mongoengine import (
     StringField,
     ListField,
     IntField,
+    FloatField,
     EmbeddedDocumentField,
     URLField,
     DateTimeField,
@@ -19,6 +20,8 @@ def drop_all_collections():
     AnnotationError.objects().delete()
     GenomeAnnotation.objects().delete()
     TaxonNode.objects().delete()
+    TaxonRankAggregate.objects().delete()
+    TaxonTreeVersion.objects().delete()
     BioProject.objects().delete()
 
 class GenomeAssembly(DynamicDocument):
@@ -83,10 +86,12 @@ class BioProject(DynamicDocument):
     accession = StringField(required=True, unique=True)
     title = StringField(required=True)
     assemblies_count = IntField()
+    rebuild_stamp = StringField() #id of the last counts update that set assemblies_count
     meta = {
         'indexes': [
             'accession',
             'title',
+            'rebuild_stamp',
         ]
     }
 
@@ -113,7 +118,7 @@ class AnnotationSequenceMap(DynamicDocument):
     annotation_id = StringField(required=True) #indexed_file_info.uncompressed_md5 of the annotation
     aliases = ListField(StringField()) #aliases for the sequence_id, e.g. chr1, 1, 1_1, 1_1_1,ucsc_style_name, refseq_accession, insdc_accession, etc.
     meta = {
-        'indexes': ['annotation_id', 'sequence_id', 'aliases']
+        'indexes': ['annotation_id', 'sequence_id', 'aliases', ('annotation_id', 'aliases')]
     }
 
 class GenomicSequence(DynamicDocument):
@@ -198,6 +203,7 @@ class GenomeAnnotation(DynamicDocument):
             "source_file_info.release_date",
             "source_file_info.last_modified",
             "source_file_info.pipeline.name",
+            ("taxid", "assembly_accession"),
         ]
     }
     def parse_iso_date(iso_date: str) -> datetime:
@@ -221,8 +227,40 @@ class TaxonNode(Document):
     annotations_count = IntField()
     organisms_count = IntField() #how many leaves are down from this node
     stats = EmbeddedDocumentField(TaxonAnnotationStats)
+    rebuild_stamp = StringField() #id of the last hierarchy rebuild that set the children of this node
+    parent_taxid = StringField() #denormalized from the children of the parent node
     meta = {
         'indexes': [
-            'taxid', 'scientific_name','children','rank'
+            'taxid', 'scientific_name','children','rank', 'rebuild_stamp', 'parent_taxid', ('rank', 'taxid')
         ]
     }
+
+
+class TaxonRankAggregate(Document):
+    """
+    Annotation gene counts averaged by taxon, precomputed by the taxon stats job for the aggregates by rank endpoint
+    """
+    taxid = StringField(required=True, unique=True)
+    rank = StringField()
+    taxon_name = StringField()
+    annotations_count = IntField()
+    avg_coding_genes_count = FloatField()
+    avg_non_coding_genes_count = FloatField()
+    avg_pseudogenes_count = FloatField()
+    rebuild_stamp = StringField() #id of the last job run that computed this row
+    meta = {
+        'indexes': [
+            ('rank', 'taxon_name'), 'rebuild_stamp'
+        ]
+    }
+
+
+TAXON_TREE_VERSION_NAME = 'taxon_tree'
+
+class TaxonTreeVersion(Document):
+    """
+    Version of the taxon nodes, replaced by the jobs after every write to the taxon hierarchy, counts or stats.
+    The API processes compare it to invalidate their in-memory flattened tree
+    """
+    name = StringField(required=True, unique=True)
+    version = StringField()
@@ -5,48 +5,54 @@ from fastapi import HTTPException
 import statistics
 
 
+# Map output keys to possible database keys (try variations)
+GENE_CATEGORY_MAPPING = {
+    "coding": ["coding", "coding_genes"],
+    "non_coding": ["non_coding", "non_coding_genes"],
+    "pseudogene": ["pseudogene", "pseudogenes"]
+}
+GENE_DB_KEYS = [db_key for possible_keys in GENE_CATEGORY_MAPPING.values() for db_key in possible_keys]
+
+def _get_stats_summary_facet(annotations, include_transcripts: bool = True) -> dict:
+    pipeline = pipelines_helper.stats_summary_facet_pipeline(GENE_DB_KEYS, include_transcripts)
+    return next(annotations.aggregate(pipeline, allowDiskUse=True), {})
+
+def _get_total_annotations(facet: dict) -> int:
+    total = facet.get("total") or []
+    return total[0]["count"] if total else 0
+
 def get_gene_stats_summary(annotations):
     """
     Get gene stats summary with specific structure for coding, non_coding, and pseudogene categories
     """
-    total_annotations = annotations.count()
-    # Map output keys to possible database keys (try variations)
-    category_mapping = {
-        "coding": ["coding", "coding_genes"],
-        "non_coding": ["non_coding", "non_coding_genes"],
-        "pseudogene": ["pseudogene", "pseudogenes"]
-    }
-    
+    facet = _get_stats_summary_facet(annotations, include_transcripts=False)
+    return _build_gene_stats_summary(_get_total_annotations(facet), facet)
+
+def _build_gene_stats_summary(total_annotations: int, facet: dict):
     # Get stats for each category
     genes = {}
     
-    for output_key, possible_keys in category_mapping.items():
-        # Try each possible key until we find one that exists
-        results = []
-        
+    for output_key, possible_keys in GENE_CATEGORY_MAPPING.items():
+        # Use the first possible key found in the database
+        totals = {}
         for db_key in possible_keys:
-            pipeline = pipelines_helper.gene_category_stats_summary_pipeline(db_key)
-            
-            results = list(annotations.aggregate(pipeline))
+            results = facet.get(f"genes_{db_key}") or []
             if results:
+                totals = results[0]
                 break
         
         # Count annotations with this category
-        annotations_count = len(results)
+        annotations_count = totals.get("annotations_count", 0)
         missing_annotations_count = total_annotations - annotations_count
         
-        # Extract values for calculations
-        total_count_values = [r["total_count"] for r in results if r.get("total_count") is not None]
-        mean_length_values = [r["mean_length"] for r in results if r.get("mean_length") is not None]
-        
         # Calculate average count (sum of all counts / annotations with this category)
         # This is the average number of genes of this category per annotation
-        total_count_sum = sum(total_count_values)
+        total_count_sum = totals.get("total_count_sum", 0)
         average_count = round(total_count_sum / annotations_count, 2) if annotations_count > 0 else None
         
         # Calculate average mean length (sum of all mean lengths / annotations with this category)
-        total_length_sum = sum(mean_length_values)
-        average_mean_length = round(total_length_sum / annotations_count, 2) if annotations_count > 0 and mean_length_values else None
+        total_length_sum = totals.get("mean_length_sum", 0)
+        average_mean_length = round(total_length_sum / annotations_count, 2) if annotations_count > 0 and totals.get("mean_length_count") else None
         
         genes[output_key] = {
             "annotations_count": annotations_count,
@@ -226,7 +232,9 @@ def get_transcript_stats_summary(annotations):
     pipeline = pipelines_helper.transcript_stats_summary_pipeline()
     
     results = list(annotations.aggregate(pipeline))
-    
+    return _build_transcript_stats_summary(total_annotations, results)
+
+def _build_transcript_stats_summary(total_annotations: int, results: list[dict]):
     # Process results and build summary
     types_summary = {}
     types_list = []
@@ -286,6 +294,18 @@ def get_transcript_stats_summary(annotations):
         "metrics": metrics
     }
 
+def get_stats_summary_bundle(annotations):
+    """
+    Get the gene and transcript stats summaries of the same annotations, computed by mongo in a single $facet
+    """
+    facet = _get_stats_summary_facet(annotations)
+    total_annotations = _get_total_annotations(facet)
+    return {
+        "total_annotations": total_annotations,
+        "genes": _build_gene_stats_summary(total_annotations, facet),
+        "transcripts": _build_transcript_stats_summary(total_annotations, facet.get("transcripts") or [])
+    }
+
 def get_transcript_type_details(transcript_type: str, annotations):
     """
     Get details for a specific transcript type
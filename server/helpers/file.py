@@ -4,6 +4,7 @@ import hashlib
 import zipfile
 import zipstream
 import tarfile
+from concurrent.futures import ThreadPoolExecutor
 from db.models import GenomeAnnotation
 
 ANNOTATIONS_PATH = os.getenv('LOCAL_ANNOTATIONS_DIR')
@@ -36,18 +37,20 @@ def get_annotation_file_path(annotation:GenomeAnnotation):
     bgzipped_path = annotation.indexed_file_info.bgzipped_path.lstrip('/') if annotation.indexed_file_info.bgzipped_path.startswith('/') else annotation.indexed_file_info.bgzipped_path
     return os.path.join(ANNOTATIONS_PATH, bgzipped_path)
 
-def remove_files(files, dir_path) -> list[str]:
+def remove_files(files, dir_path, max_workers: int=32) -> list[str]:
     """
     Remove the files and any now-empty parent directories up to `dir_path`.
+    Unlinks are I/O bound, so they are dispatched to a thread pool.
     return the paths of the files that were deleted
     """
-    deleted_files = []
-    for f in files:
-        if not f or not os.path.exists(f):
-            continue
-        remove_file_and_empty_parents(f, dir_path)
-        deleted_files.append(f)
-    return deleted_files
+    files_to_delete = [f for f in files if f and os.path.exists(f)]
+    if len(files_to_delete) <= 1:
+        for f in files_to_delete:
+            remove_file_and_empty_parents(f, dir_path)
+        return files_to_delete
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(files_to_delete))) as executor:
+        list(executor.map(lambda f: remove_file_and_empty_parents(f, dir_path), files_to_delete))
+    return files_to_delete
 
 def check_file_exists_and_not_empty(file_path):
     # Check if the file exists
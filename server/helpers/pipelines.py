@@ -1,6 +1,7 @@
 
 
 def gene_category_stats_summary_pipeline(db_key: str):
+    mean_length = f"$features_statistics.gene_category_stats.{db_key}.length_stats.mean"
     return  [
                 {
                     "$match": {
@@ -8,10 +9,14 @@ def gene_category_stats_summary_pipeline(db_key: str):
                     }
                 },
                 {
-                    "$project": {
-                        "annotation_id": "$annotation_id",
-                        "total_count": f"$features_statistics.gene_category_stats.{db_key}.total_count",
-                        "mean_length": f"$features_statistics.gene_category_stats.{db_key}.length_stats.mean"
+                    "$group": {
+                        "_id": None,
+                        "annotations_count": {"$sum": 1},
+                        "total_count_sum": {"$sum": f"$features_statistics.gene_category_stats.{db_key}.total_count"},
+                        "mean_length_sum": {"$sum": mean_length},
+                        "mean_length_count": {
+                            "$sum": {"$cond": [{"$eq": [{"$ifNull": [mean_length, None]}, None]}, 0, 1]}
+                        }
                     }
                 }
             ]
@@ -171,6 +176,43 @@ def transcript_stats_summary_pipeline():
     ]
 
 
+def taxon_parents_pipeline(taxon_collection_name: str, match: dict | None = None):
+    """
+    Set the parent_taxid of the taxon nodes from the children lists of their parents, run on the taxon node collection.
+    Nodes without parent get a null parent_taxid
+    """
+    return [
+        *([{"$match": match}] if match else []),
+        {"$project": {"_id": 0, "taxid": 1}},
+        {"$lookup": {
+            "from": taxon_collection_name,
+            "localField": "taxid",
+            "foreignField": "children",
+            "pipeline": [{"$project": {"_id": 0, "taxid": 1}}],
+            "as": "parents",
+        }},
+        {"$project": {"taxid": 1, "parent_taxid": {"$ifNull": [{"$first": "$parents.taxid"}, None]}}},
+        {"$merge": {
+            "into": taxon_collection_name,
+            "on": "taxid",
+            "whenMatched": "merge",
+            "whenNotMatched": "discard",
+        }},
+    ]
+
+def stats_summary_facet_pipeline(gene_db_keys: list[str], include_transcripts: bool = True):
+    """
+    Compute the annotations count, the gene category totals and optionally the transcript type totals in a single $facet,
+    so mongo runs every summary over the same matched annotations in one round-trip
+    """
+    facets = {"total": [{"$count": "count"}]}
+    for db_key in gene_db_keys:
+        facets[f"genes_{db_key}"] = gene_category_stats_summary_pipeline(db_key)
+    if include_transcripts:
+        facets["transcripts"] = transcript_stats_summary_pipeline()
+    return [{"$facet": facets}]
+
+
 def transcript_type_details_pipeline(transcript_type: str):
     return [
         {
@@ -257,171 +299,47 @@ def transcript_type_metric_values_pipeline(field_path: str):
     ]
 
 
-def aggregate_by_taxon_pipeline(rank: str):
+def taxon_rank_aggregates_pipeline(rebuild_stamp: str):
+    """
+    Aggregate annotation gene-category counts by taxon, computed in one pass for the taxons of every rank.
+    Returns per-taxon: avg coding/non_coding/pseudogene counts (rounded to 2 decimals)
+    and annotation count. Annotations without a value for a category are skipped
+    for that category's average (not counted as 0).
+    """
     return [
-        # 1. lookup taxon info for each annotation
         {
             "$lookup": {
                 "from": "taxon_node",
                 "localField": "taxon_lineage",
                 "foreignField": "taxid",
+                "pipeline": [{"$project": {"_id": 0, "taxid": 1, "rank": 1, "scientific_name": 1}}],
                 "as": "taxons",
             }
         },
         {"$unwind": "$taxons"},
-        {"$match": {"taxons.rank": rank}},
-
-        # 2. group by taxon
+        {"$match": {"taxons.rank": {"$ne": None}}},
         {
             "$group": {
                 "_id": "$taxons.taxid",
+                "rank": {"$first": "$taxons.rank"},
                 "taxon_name": {"$first": "$taxons.scientific_name"},
                 "avg_coding_genes_count": {"$avg": "$features_statistics.gene_category_stats.coding.total_count"},
                 "avg_non_coding_genes_count": {"$avg": "$features_statistics.gene_category_stats.non_coding.total_count"},
                 "avg_pseudogenes_count": {"$avg": "$features_statistics.gene_category_stats.pseudogene.total_count"},
-                "count": {"$sum": 1},
+                "annotations_count": {"$sum": 1},
             }
         },
-
-        # 3. round averages
         {
             "$project": {
-                "_id": 1,
+                "_id": 0,
+                "taxid": "$_id",
+                "rank": 1,
                 "taxon_name": 1,
+                "annotations_count": 1,
                 "avg_coding_genes_count": {"$round": ["$avg_coding_genes_count", 2]},
                 "avg_non_coding_genes_count": {"$round": ["$avg_non_coding_genes_count", 2]},
                 "avg_pseudogenes_count": {"$round": ["$avg_pseudogenes_count", 2]},
-                "count": 1,
+                "rebuild_stamp": rebuild_stamp,
             }
         },
-
-        # 4. sort by name
-        {"$sort": {"taxon_name": 1}},
     ]
-
-    """
-    Aggregate annotation gene-category counts by taxon at the given rank.
-    Returns per-taxon: avg coding/non_coding/pseudogene counts (rounded to 2 decimals)
-    and annotation count. Annotations without a value for a category are skipped
-    for that category's average (not counted as 0).
-    Run with GenomeAnnotation.objects.aggregate(...).
-    """
-    return [
-        {
-            "$lookup": {
-                "from": "taxon_node",
-                "let": {"lineage": "$taxon_lineage", "rank_filter": rank},
-                "pipeline": [
-                    {
-                        "$match": {
-                            "$expr": {
-                                "$and": [
-                                    {"$in": ["$taxid", "$$lineage"]},
-                                    {"$eq": ["$rank", "$$rank_filter"]},
-                                ]
-                            }
-                        }
-                    },
-                    {"$limit": 1},
-                ],
-                "as": "taxon",
-            }
-        },
-        {"$unwind": {"path": "$taxon", "preserveNullAndEmptyArrays": False}},
-        {
-            "$group": {
-                "_id": "$taxon.taxid",
-                "taxon_name": {"$first": "$taxon.scientific_name"},
-                "avg_coding_genes_count": {
-                    "$avg": {
-                        "$cond": [
-                            {
-                                "$and": [
-                                    {
-                                        "$ne": [
-                                            "$features_statistics.gene_category_stats.coding.total_count",
-                                            None,
-                                        ]
-                                    },
-                                    {
-                                        "$ne": [
-                                            {
-                                                "$type": "$features_statistics.gene_category_stats.coding.total_count"
-                                            },
-                                            "missing",
-                                        ],
-                                    },
-                                ]
-                            },
-                            "$features_statistics.gene_category_stats.coding.total_count",
-                            None,
-                        ]
-                    }
-                },
-                "avg_non_coding_genes_count": {
-                    "$avg": {
-                        "$cond": [
-                            {
-                                "$and": [
-                                    {
-                                        "$ne": [
-                                            "$features_statistics.gene_category_stats.non_coding.total_count",
-                                            None,
-                                        ]
-                                    },
-                                    {
-                                        "$ne": [
-                                            {
-                                                "$type": "$features_statistics.gene_category_stats.non_coding.total_count"
-                                            },
-                                            "missing",
-                                        ],
-                                    },
-                                ]
-                            },
-                            "$features_statistics.gene_category_stats.non_coding.total_count",
-                            None,
-                        ]
-                    }
-                },
-                "avg_pseudogenes_count": {
-                    "$avg": {
-                        "$cond": [
-                            {
-                                "$and": [
-                                    {
-                                        "$ne": [
-                                            "$features_statistics.gene_category_stats.pseudogene.total_count",
-                                            None,
-                                        ]
-                                    },
-                                    {
-                                        "$ne": [
-                                            {
-                                                "$type": "$features_statistics.gene_category_stats.pseudogene.total_count"
-                                            },
-                                            "missing",
-                                        ],
-                                    },
-                                ]
-                            },
-                            "$features_statistics.gene_category_stats.pseudogene.total_count",
-                            None,
-                        ]
-                    }
-                },
-                "count": {"$sum": 1},
-            }
-        },
-        {
-            "$project": {
-                "_id": 1,
-                "taxon_name": 1,
-                "avg_coding_genes_count": {"$round": ["$avg_coding_genes_count", 2]},
-                "avg_non_coding_genes_count": {"$round": ["$avg_non_coding_genes_count", 2]},
-                "avg_pseudogenes_count": {"$round": ["$avg_pseudogenes_count", 2]},
-                "count": 1,
-            }
-        },
-        {"$sort": {"taxon_name": 1}},
-    ]
\ No newline at end of file
@@ -1,18 +1,37 @@
 from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from typing import Iterable
+import orjson
 
-def json_response_with_pagination(items, count, offset, limit):
-    """Format response as JSON with pagination."""
+ROWS_JSON_BUFFER_SIZE = 5000
+DEFAULT_PAGINATION_LIMIT = 20
+MAX_PAGINATION_LIMIT = 1000
+
+def count_queryset(queryset) -> int:
+    """
+    Count the documents of a queryset, using the collection metadata count when the queryset has no filter
+    """
+    if not queryset._query:
+        return queryset._document._get_collection().estimated_document_count()
+    return queryset.count()
+
+def _pagination_bounds(offset, limit) -> tuple[int, int]:
     #force offset and limit to be int
     try:
         offset = int(offset)
         limit = int(limit)
     except:
         offset = 0
-        limit = 20
+        limit = DEFAULT_PAGINATION_LIMIT
     if limit == 0:
-        limit = 20 # back to default limit
-    elif limit > 1000:
-        raise HTTPException(status_code=400, detail="Limit must be less or equal to 1000")
+        limit = DEFAULT_PAGINATION_LIMIT # back to default limit
+    elif limit > MAX_PAGINATION_LIMIT:
+        raise HTTPException(status_code=400, detail=f"Limit must be less or equal to {MAX_PAGINATION_LIMIT}")
+    return offset, limit
+
+def json_response_with_pagination(items, count, offset, limit):
+    """Format response as JSON with pagination."""
+    offset, limit = _pagination_bounds(offset, limit)
     
     paginated_items = items.skip(offset).limit(limit).exclude('id').as_pymongo()
     return {
@@ -21,3 +40,43 @@ def json_response_with_pagination(items, count, offset, limit):
         'limit': limit,
         'results': list(paginated_items)
     }
+
+def raw_json_response_with_pagination(queryset, count, offset, limit):
+    """
+    Same response as json_response_with_pagination, but the page is read with a single raw pymongo find
+    built from the queryset filter, projection and ordering, the documents are returned as plain dicts
+    """
+    offset, limit = _pagination_bounds(offset, limit)
+    projection = queryset._loaded_fields.as_dict()
+    projection['_id'] = 0
+    cursor = queryset._document._get_collection().find(queryset._query, projection)
+    if queryset._ordering:
+        cursor = cursor.sort(queryset._ordering)
+    cursor = cursor.skip(offset).limit(limit).batch_size(limit)
+    return {
+        'total': count,
+        'offset': offset,
+        'limit': limit,
+        'results': list(cursor)
+    }
+
+
+def stream_rows_json(fields: list[str], rows: Iterable[list]):
+    """
+    Stream a {"fields": [...], "rows": [[...], ...]} JSON document, encoding the rows incrementally
+    """
+    def row_iterator():
+        yield b'{"fields":' + orjson.dumps(fields) + b',"rows":['
+        buffer: list[bytes] = []
+        separator = b""
+        for row in rows:
+            buffer.append(orjson.dumps(row))
+            if len(buffer) >= ROWS_JSON_BUFFER_SIZE:
+                yield separator + b",".join(buffer)
+                separator = b","
+                buffer.clear()
+        if buffer:
+            yield separator + b",".join(buffer)
+        yield b"]}"
+
+    return StreamingResponse(row_iterator(), media_type="application/json")
@@ -87,6 +87,7 @@ def import_annotations():
     #UPDATE DB AND TAXON GENE STATS
     stats_service.update_db_stats()
     stats_service.update_taxon_gene_stats()
+    stats_service.update_taxon_rank_aggregates()
     print("Import annotations job successfully finished")
 
 def process_annotations_pipeline(annotations: list[AnnotationToProcess], valid_lineages: dict[str, list[str]], existing_annotation_md5s: list[str]) -> list[GenomeAnnotation]:
@@ -375,10 +375,12 @@ def delete_annotations(query: Union[dict, Q], annotations_path: str):
     if count == 0:
         return
     print(f"Deleting {count} annotations")
-    remove_files_from_annotations(annotations_to_delete, annotations_path)
-    annotation_ids = list(annotations_to_delete.scalar('annotation_id'))
-    AnnotationSequenceMap.objects(annotation_id__in=annotation_ids).delete()
-    annotations_to_delete.delete()
+    #one projected pass to collect the ids and the file paths
+    annotations_with_files = list(annotations_to_delete.only('annotation_id', 'indexed_file_info'))
+    remove_files_from_annotations(annotations_with_files, annotations_path)
+    annotation_ids = [annotation.annotation_id for annotation in annotations_with_files]
+    AnnotationSequenceMap._get_collection().delete_many({"annotation_id": {"$in": annotation_ids}})
+    GenomeAnnotation._get_collection().delete_many({"annotation_id": {"$in": annotation_ids}})
     print(f"Deleted {count} annotations")
 
 
@@ -386,10 +388,13 @@ def clean_up_annotations_with_errors():
     """
     Clean up the annotations with errors which url paths are the same as the ones in the valid annotations
     """
-    annotations_with_errors_urls = AnnotationError.objects().scalar('url_path')
-    existing_annotations = GenomeAnnotation.objects(source_file_info__url_path__in=annotations_with_errors_urls)
-    for annotation in existing_annotations:
-        AnnotationError.objects(url_path=annotation.source_file_info.url_path).delete()
+    annotations_with_errors_urls = AnnotationError.objects().distinct('url_path')
+    if not annotations_with_errors_urls:
+        return
+    #url paths of the errors that now have a valid annotation, resolved in one query
+    existing_urls = GenomeAnnotation.objects(source_file_info__url_path__in=annotations_with_errors_urls).distinct('source_file_info.url_path')
+    if existing_urls:
+        AnnotationError.objects(url_path__in=existing_urls).delete()
 
 
 
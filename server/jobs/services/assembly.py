@@ -1,4 +1,6 @@
 import os
+import shutil
+import tempfile
 from db.models import BioProject, GenomeAssembly, AssemblyStats, GenomicSequence
 from clients import ncbi_datasets as ncbi_datasets_client
 from .classes import AnnotationToProcess, AssemblyReportSequence
@@ -7,7 +9,10 @@ import asyncio
 import aiohttp
 from typing import Iterator
 import time
+from concurrent.futures import ThreadPoolExecutor
+from pymongo.errors import BulkWriteError
 
+DUPLICATE_KEY_ERROR = 11000
 
 def get_existing_accessions(accessions: list[str]) -> list[str]:
     """
@@ -62,8 +67,7 @@ def fetch_new_assemblies_and_bioprojects(new_accessions: list[str], tmp_dir: str
 
         assemblies_path = os.path.join(tmp_dir, f'assemblies_{idx}_{len(batch)}.txt')
         with open(assemblies_path, 'w') as f:
-            for assembly in batch: 
-                f.write(assembly + '\n')
+            f.write('\n'.join(batch) + '\n')
         cmd = ['genome', 'accession', '--inputfile', assemblies_path]
         ncbi_report = ncbi_datasets_client.get_data_from_ncbi(cmd)
         assemblies_to_save: list[GenomeAssembly] = [
@@ -82,17 +86,22 @@ def fetch_new_assemblies_and_bioprojects(new_accessions: list[str], tmp_dir: str
             #delete the assemblies that were saved, we will retry it in the next job
             GenomeAssembly.objects(assembly_accession__in=found_accessions).delete()
             continue
-    existing_bioprojects = BioProject.objects(accession__in=list(bioprojects_to_save.keys())).scalar('accession')
-    bioprojects_to_save = {accession: bioproject for accession, bioproject in bioprojects_to_save.items() if accession not in existing_bioprojects}
     if bioprojects_to_save:
-        #filter out existing bioprojects
+        #existing bioprojects are rejected by the unique accession index, no need to query them first
+        bioprojects = list(bioprojects_to_save.values())
         try:
-            BioProject.objects.insert(list(bioprojects_to_save.values()))
-        except Exception as e:
-            print(f"Error upserting bioproject batch: {e}")
-            #delete the bioprojects that were saved
-            BioProject.objects(accession__in=list(bioprojects_to_save.keys())).delete()        
-            raise e
+            BioProject._get_collection().insert_many(
+                [bioproject.to_mongo() for bioproject in bioprojects], ordered=False, bypass_document_validation=True
+            )
+        except BulkWriteError as e:
+            write_errors = e.details.get('writeErrors', [])
+            if any(error.get('code') != DUPLICATE_KEY_ERROR for error in write_errors):
+                print(f"Error upserting bioproject batch: {e}")
+                #delete the bioprojects that were saved in this batch
+                failed_indexes = {error.get('index') for error in write_errors}
+                inserted_accessions = [bioproject.accession for idx, bioproject in enumerate(bioprojects) if idx not in failed_indexes]
+                BioProject.objects(accession__in=inserted_accessions).delete()
+                raise e
     return saved_accessions
 
 def save_chromosomes(chromosomes_tuples: list[tuple[str, list[AssemblyReportSequence]]], acc_to_name: dict[str, str], batch_size: int=5000):
@@ -350,7 +359,7 @@ def update_assemblies_from_ncbi_report(ncbi_report: dict):
     """
     results = ncbi_report.get('reports', [])
     accessions = [assembly.get('accession') for assembly in results]
-    acc_to_ass_map = {ass.assembly_accession: ass for ass in GenomeAssembly.objects(assembly_accession__in=accessions)}
+    acc_to_ass_map = build_assembly_lookup(accessions, fields=['assembly_accession', 'assembly_status', 'refseq_category', 'organism_name', 'taxid'])
     for assembly in results:
         assembly_info = assembly.get('assembly_info', dict())
         organism_info = assembly.get('organism', dict())
@@ -373,35 +382,52 @@ def update_assemblies_from_ncbi_report(ncbi_report: dict):
             #clean up taxon lineage if taxid changed
             update_payload['taxon_lineage'] = []
         if update_payload:  
-            assembly_object.modify(**update_payload)
+            GenomeAssembly.objects(pk=assembly_object.pk).update_one(**update_payload)
+
+
+def get_data_from_ncbi_after_delay(cmd: list[str], delay: float):
+    """
+    Wait delay seconds, then fetch the data from NCBI Datasets
+    """
+    if delay:
+        time.sleep(delay)
+    return ncbi_datasets_client.get_data_from_ncbi(cmd)
 
 
 def update_assemblies_from_ncbi(accessions: list[str], tmp_dir: str, batch_size: int=1000):
     """
     Fetch assemblies from NCBI Datasets and update the db with the updated fields if any field has changed
+    - accessions: list of accessions, pass a materialized list: a db cursor would stay open across the NCBI calls
     """
     batches = create_batches(accessions, batch_size)
-    files_to_delete = []
+    #process-local subdirectory for the batch files, removed at once at the end
+    tmp_root = tempfile.mkdtemp(prefix='annotrieve-assemblies-', dir=tmp_dir)
     try:
-        for idx, batch in enumerate(batches):
-            if idx > 0:
-                time.sleep(1)
-            assemblies_path = os.path.join(tmp_dir, f'assemblies_to_update_{idx}_{len(batch)}.txt')
-            files_to_delete.append(assemblies_path)
-            with open(assemblies_path, 'w') as f:
-                for accession in batch:
-                    f.write(accession + '\n')
-            cmd = ['genome', 'accession', '--inputfile', assemblies_path]
-            ncbi_report = ncbi_datasets_client.get_data_from_ncbi(cmd)
-            if ncbi_report:
-                update_assemblies_from_ncbi_report(ncbi_report)
+        # A single background worker keeps one NCBI call in flight (respecting the client rate limiting)
+        # while the report of the previous batch is written to the db
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending_report = None
+            for idx, batch in enumerate(batches):
+                assemblies_path = os.path.join(tmp_root, f'assemblies_to_update_{idx}_{len(batch)}.txt')
+                with open(assemblies_path, 'w') as f:
+                    f.write('\n'.join(batch) + '\n')
+                cmd = ['genome', 'accession', '--inputfile', assemblies_path]
+                #the pause runs on the worker thread, so consecutive NCBI calls stay 1s apart
+                next_report = executor.submit(get_data_from_ncbi_after_delay, cmd, 1 if idx > 0 else 0)
+                if pending_report:
+                    ncbi_report = pending_report.result()
+                    if ncbi_report:
+                        update_assemblies_from_ncbi_report(ncbi_report)
+                pending_report = next_report
+            if pending_report:
+                ncbi_report = pending_report.result()
+                if ncbi_report:
+                    update_assemblies_from_ncbi_report(ncbi_report)
     except Exception as e:
         print(f"Error updating data: {e}")
     finally:
         #delete the tmp files
-        for file_to_delete in files_to_delete:
-            if os.path.exists(file_to_delete):
-                os.remove(file_to_delete)
+        shutil.rmtree(tmp_root, ignore_errors=True)
         print("Updated assemblies")
 
 
@@ -413,5 +439,5 @@ def build_assembly_lookup(accessions: list[str], fields: list[str]=['assembly_ac
         a.assembly_accession: a
         for a in GenomeAssembly.objects(
             assembly_accession__in=accessions
-        ).only(*fields)
+        ).only(*fields).no_cache()
     }
\ No newline at end of file
@@ -7,9 +7,9 @@ def handle_alias_mapping(parsed_annotation: GenomeAnnotation, bgzipped_path: str
     handle the alias mapping for the annotation and store them in the database
     """
     #CHROMOSOMES STEP
-    chromosomes = GenomicSequence.objects(assembly_accession=parsed_annotation.assembly_accession)
+    chromosomes = list(GenomicSequence.objects(assembly_accession=parsed_annotation.assembly_accession).only('genbank_accession', 'refseq_accession', 'aliases'))
     
-    if chromosomes.count() == 0:
+    if not chromosomes:
         return
 
     chr_aliases_dict = {} #dict with all possible combinations of aliases for the chromosomes
@@ -43,6 +43,9 @@ DNA_REGION_CODES = set([
     "scaffold_region",
 ])
 
+#bump when compute_features_statistics changes, annotations with an older version are recomputed by the update_feature_stats backfill (POST /jobs/update/features/stats)
+CURRENT_SCHEMA_VERSION = 2
+
 
 def compute_features_statistics(bgzipped_path: str) -> GFFStats:
     """
@@ -481,5 +484,6 @@ def compute_features_statistics(bgzipped_path: str) -> GFFStats:
     
     return GFFStats(
         gene_category_stats=gene_category_stats_dict,
-        transcript_type_stats=transcript_type_stats_dict
+        transcript_type_stats=transcript_type_stats_dict,
+        schema_version=CURRENT_SCHEMA_VERSION
     )
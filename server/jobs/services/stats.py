@@ -1,9 +1,13 @@
-from db.models import GenomeAssembly, GenomeAnnotation, Organism, TaxonNode, BioProject
+from db.models import GenomeAssembly, GenomeAnnotation, Organism, TaxonNode, BioProject, TaxonRankAggregate
 from db.embedded_documents import DistributionStats, TaxonAnnotationStats, TaxonGeneStats, TaxonGeneCategoryStats
 import math
 from typing import List
 from collections import defaultdict
-from .utils import create_batches
+from .utils import iter_batches, iter_scalar
+from pymongo.operations import UpdateOne
+from bson import ObjectId
+from helpers import pipelines as pipelines_helper
+from .taxonomy import bump_taxon_tree_version
 
 def update_assemblies_counts():
     """
@@ -18,8 +22,8 @@ def update_assemblies_counts():
     for row in GenomeAnnotation.objects.aggregate(*pipeline):
         counts[row["_id"]] = row["count"]
 
-    for assembly in GenomeAssembly.objects():
-        assembly.modify(
+    for assembly in GenomeAssembly.objects().only('assembly_accession'):
+        GenomeAssembly.objects(pk=assembly.pk).update_one(
             annotations_count=counts.get(assembly.assembly_accession, 0)
         )
 
@@ -46,8 +50,8 @@ def update_organisms_counts():
     for row in GenomeAnnotation.objects.aggregate(*pipeline):
         annotation_counts[row["_id"]] = row["count"]
 
-    for organism in Organism.objects():
-        organism.modify(
+    for organism in Organism.objects().only('taxid'):
+        Organism.objects(pk=organism.pk).update_one(
             annotations_count=annotation_counts.get(organism.taxid, 0),
             assemblies_count=assembly_counts.get(organism.taxid, 0),
         )
@@ -71,23 +75,25 @@ def update_taxon_nodes_counts():
         {"$unwind": "$taxon_lineage"},
         {"$group": {"_id": "$taxon_lineage", "count": {"$sum": 1}}}
     ]
-    for row in GenomeAnnotation.objects.aggregate(*pipeline):
+    for row in GenomeAnnotation._get_collection().aggregate(pipeline, allowDiskUse=True):
         annotation_counts[row["_id"]] = row["count"]
-    for row in GenomeAssembly.objects.aggregate(*pipeline):
+    for row in GenomeAssembly._get_collection().aggregate(pipeline, allowDiskUse=True):
         assembly_counts[row["_id"]] = row["count"]
-    for row in Organism.objects.aggregate(*pipeline):
+    for row in Organism._get_collection().aggregate(pipeline, allowDiskUse=True):
         organism_counts[row["_id"]] = row["count"]
-    # Update taxon nodes in batches to avoid loading all into memory
+    # Update taxon nodes in batches to avoid loading all into memory, one bulk write per batch
     batch_size = 1000
-    taxon_taxids = list(TaxonNode.objects().scalar('taxid'))
-    for batch_taxids in create_batches(taxon_taxids, batch_size):
-        taxon_nodes_batch = TaxonNode.objects(taxid__in=batch_taxids)
-        for taxon_node in taxon_nodes_batch:
-            taxon_node.modify(
-                annotations_count=annotation_counts.get(taxon_node.taxid, 0),
-                assemblies_count=assembly_counts.get(taxon_node.taxid, 0),
-                organisms_count=organism_counts.get(taxon_node.taxid, 0)
-            )
+    taxon_nodes_collection = TaxonNode._get_collection()
+    for batch_taxids in iter_batches(iter_scalar(TaxonNode.objects(), 'taxid'), batch_size):
+        bulk_ops = [
+            UpdateOne({"taxid": taxid}, {"$set": {
+                "annotations_count": annotation_counts.get(taxid, 0),
+                "assemblies_count": assembly_counts.get(taxid, 0),
+                "organisms_count": organism_counts.get(taxid, 0),
+            }})
+            for taxid in batch_taxids
+        ]
+        taxon_nodes_collection.bulk_write(bulk_ops, ordered=False)
     #delete taxon nodes without annotations and update children
     taxon_nodes_to_delete = TaxonNode.objects(annotations_count=0)
     taxons_to_delete_count = taxon_nodes_to_delete.count()
@@ -101,23 +107,28 @@ def update_taxon_nodes_counts():
         TaxonNode.objects(children__in=taxids_to_delete).update(
             pull_all__children=taxids_to_delete
         )
+    bump_taxon_tree_version()
     print("Taxon nodes counts updated")
 
 def update_bioprojects_counts():
     """
     Update the bioprojects counts for the bioprojects
     """
-    assembly_counts = defaultdict(int)
     pipeline = [
         {"$unwind": "$bioprojects"},
         {"$group": {"_id": "$bioprojects", "count": {"$sum": 1}}}
     ]
-    for row in GenomeAssembly.objects.aggregate(*pipeline):
-        assembly_counts[row["_id"]] = row["count"]
-    for bioproject in BioProject.objects():
-        bioproject.modify(
-            assemblies_count=assembly_counts.get(bioproject.accession, 0),
-        )
+    bioprojects_collection = BioProject._get_collection()
+    #write the new counts stamped by this run first, readers never see a bioproject reset to 0 in between
+    rebuild_stamp = str(ObjectId())
+    bulk_ops = (
+        UpdateOne({"accession": row["_id"]}, {"$set": {"assemblies_count": row["count"], "rebuild_stamp": rebuild_stamp}})
+        for row in GenomeAssembly._get_collection().aggregate(pipeline, allowDiskUse=True)
+    )
+    for batch_ops in iter_batches(bulk_ops, 1000):
+        bioprojects_collection.bulk_write(batch_ops, ordered=False)
+    #bioprojects not stamped by this run are not referenced by any assembly
+    bioprojects_collection.update_many({"rebuild_stamp": {"$ne": rebuild_stamp}}, {"$set": {"assemblies_count": 0}})
     orphan_bioprojects = BioProject.objects(assemblies_count=0)
     orphan_bioprojects_count = orphan_bioprojects.count()
     if orphan_bioprojects_count > 0:
@@ -214,11 +225,9 @@ def update_taxon_gene_stats():
     # Update taxon nodes in batches
     batch_size = 1000
     
-    # Also get all taxon taxids that might not have any annotations
-    all_taxon_taxids = set(TaxonNode.objects().scalar('taxid'))
-    
-    for batch_taxids in create_batches(list(all_taxon_taxids), batch_size):
-        taxon_nodes_batch = TaxonNode.objects(taxid__in=batch_taxids)
+    # Also stream all taxon taxids that might not have any annotations
+    for batch_taxids in iter_batches(iter_scalar(TaxonNode.objects(), 'taxid'), batch_size):
+        taxon_nodes_batch = TaxonNode.objects(taxid__in=batch_taxids).only('taxid')
         for taxon in taxon_nodes_batch:
             counts = taxon_counts.get(taxon.taxid, {"coding": [], "non_coding": [], "pseudogene": []})
             
@@ -226,8 +235,30 @@ def update_taxon_gene_stats():
             non_coding = TaxonGeneCategoryStats(count=compute_distribution_stats(counts.get("non_coding", [])))
             pseudogene = TaxonGeneCategoryStats(count=compute_distribution_stats(counts.get("pseudogene", [])))
             
-            taxon.modify(stats=TaxonAnnotationStats(
+            TaxonNode.objects(pk=taxon.pk).update_one(stats=TaxonAnnotationStats(
                 genes=TaxonGeneStats(coding=coding, non_coding=non_coding, pseudogene=pseudogene)
             ))
 
-    print("Taxon gene stats updated")
\ No newline at end of file
+    bump_taxon_tree_version()
+    print("Taxon gene stats updated")
+
+
+def update_taxon_rank_aggregates():
+    """
+    Precompute the annotation gene counts averaged by taxon for every rank, so the aggregates endpoint reads them with an indexed find.
+    Rows are $merge-d and stamped by this run, the rows of taxons no longer found are deleted afterwards
+    """
+    rebuild_stamp = str(ObjectId())
+    # make sure the unique taxid index required by $merge exists
+    aggregate_collection = TaxonRankAggregate._get_collection()
+    pipeline = pipelines_helper.taxon_rank_aggregates_pipeline(rebuild_stamp) + [
+        {"$merge": {
+            "into": TaxonRankAggregate._get_collection_name(),
+            "on": "taxid",
+            "whenMatched": "replace",
+            "whenNotMatched": "insert",
+        }}
+    ]
+    GenomeAnnotation._get_collection().aggregate(pipeline, allowDiskUse=True)
+    result = aggregate_collection.delete_many({'rebuild_stamp': {'$ne': rebuild_stamp}})
+    print(f"Updated taxon rank aggregates, deleted {result.deleted_count} stale rows")
@@ -1,14 +1,29 @@
-from db.models import TaxonNode, Organism, GenomeAssembly, GenomeAnnotation
-from collections import defaultdict
+from db.models import TaxonNode, Organism, GenomeAssembly, GenomeAnnotation, TaxonTreeVersion, TAXON_TREE_VERSION_NAME
 from clients import ebi_client
+from helpers import pipelines as pipelines_helper
 from lxml import etree
 from .classes import AnnotationToProcess, OrganismToProcess
 import os
-from .utils import create_batches
+from .utils import create_batches, iter_batches
 import gzip
 from itertools import chain
+from typing import Iterable
+from bson import ObjectId
 from pymongo.operations import UpdateOne
 
+# compiled once, evaluated for every top-level taxon of the ENA XML
+_LINEAGE_TAXONS = etree.XPath("./lineage/taxon", smart_strings=False)
+
+HIERARCHY_WRITE_BATCH_SIZE = 1000
+
+def bump_taxon_tree_version():
+    """
+    Store a new taxon tree version, the API processes rebuild their cached flattened tree on the next request
+    """
+    TaxonTreeVersion._get_collection().update_one(
+        {'name': TAXON_TREE_VERSION_NAME}, {'$set': {'version': str(ObjectId())}}, upsert=True
+    )
+
 def get_existing_lineages_dict(annotations: list[AnnotationToProcess])->dict[str, list[str]]:
     """
     Get the existing lineages for the taxids in the annotations. return a dict of taxid:lineage (from species to root)
@@ -36,19 +51,21 @@ def handle_taxonomy(annotations: list[AnnotationToProcess], tmp_dir: str, batch_
         return lineages
 
     print(f"Saved {len(saved_taxids)} new organisms")
+    saved_taxids = set(saved_taxids)
     successfully_saved_organisms = [organism for organism in organisms_to_process if organism.taxon_id in saved_taxids]
     
     print("Saving taxonomies")
     save_taxons(successfully_saved_organisms)
 
     print("Updating taxon hierarchy")
-    organisms_to_update = Organism.objects(taxid__in=saved_taxids)
-    for organism in organisms_to_update:
-        ordered_taxons = get_ordered_taxons(organism.taxon_lineage)
-        update_taxon_hierarchy(ordered_taxons)
+    # the saved organisms are already in memory with the lineages just persisted, no need to read them back
+    # load all the related taxons at once instead of one query per organism
+    taxon_map = get_taxon_map(chain(*[organism.taxon_lineage for organism in successfully_saved_organisms]))
+    update_taxon_hierarchy(get_ordered_taxons(organism.taxon_lineage, taxon_map) for organism in successfully_saved_organisms)
         
     print("Taxon hierarchy updated")
-    lineages = get_existing_lineages_dict(annotations)
+    # the saved organisms carry the persisted lineages, no need to query them again
+    lineages.update({organism.taxon_id: organism.taxon_lineage for organism in successfully_saved_organisms})
     return lineages #return all the valid lineages
 
 
@@ -94,12 +111,26 @@ def save_organisms(organisms_to_process: list[OrganismToProcess], batch_size: in
     
     return saved_taxids
 
+def get_existing_taxids(taxids: list[str], batch_size: int=5000)->set[str]:
+    """
+    Get the taxids that already exist as taxon nodes, using a covered query on the taxid index (no document fetch)
+    """
+    taxon_collection = TaxonNode._get_collection()
+    existing_taxids = set()
+    for batch in create_batches(taxids, batch_size):
+        cursor = taxon_collection.find(
+            {'taxid': {'$in': batch}},
+            {'taxid': 1, '_id': 0}
+        ).hint([('taxid', 1)])
+        existing_taxids.update(doc['taxid'] for doc in cursor)
+    return existing_taxids
+
 def save_taxons(organisms_to_process: list[OrganismToProcess], batch_size: int=5000)->bool | list[str]:
     """
     Save new taxons and return the list of taxids of saved taxons
     """
     all_taxids = set(chain(*[organism.taxon_lineage for organism in organisms_to_process]))
-    existing_taxids = set(TaxonNode.objects(taxid__in=list(all_taxids)).scalar('taxid'))
+    existing_taxids = get_existing_taxids(list(all_taxids), batch_size)
     new_taxids = all_taxids - existing_taxids
 
     # Deduplicate by taxid while keeping the first occurrence
@@ -129,24 +160,42 @@ def save_taxons(organisms_to_process: list[OrganismToProcess], batch_size: int=5
     print(f"Total taxons saved: {len(saved_taxids)}")
     return saved_taxids
 
-def get_ordered_taxons(taxids: list[str])->list[TaxonNode]:
+def get_taxon_map(taxids: Iterable[str])->dict[str, TaxonNode]:
+    """
+    Load the taxons from database in a single query and return a dict of taxid:TaxonNode
     """
-    Reload taxons from database and return them ordered by lineage from species to root
+    reloaded_taxons = TaxonNode.objects(taxid__in=list(set(taxids))).only('taxid')
+    return {t.taxid: t for t in reloaded_taxons}
+
+def get_ordered_taxons(taxids: list[str], taxon_map: dict[str, TaxonNode] | None = None)->list[TaxonNode]:
     """
-    reloaded_taxons = TaxonNode.objects(taxid__in=taxids)
-    taxon_map = {t.taxid: t for t in reloaded_taxons}
+    Return the taxons ordered by lineage from species to root, reloading them from database if no taxon_map is provided
+    """
+    if taxon_map is None:
+        taxon_map = get_taxon_map(taxids)
     # Filter out any taxids that weren't found in the database
     return [taxon_map[t] for t in taxids if t in taxon_map]
 
 
-def update_taxon_hierarchy(ordered_taxons: list[TaxonNode]):
+def update_taxon_hierarchy(ordered_lineages: Iterable[list[TaxonNode]], batch_size: int=HIERARCHY_WRITE_BATCH_SIZE):
     """
-    Update the taxon hierarchy in a best-effort manner, add the children to the father taxon
+    Update the taxon hierarchy in a best-effort manner, add the children to the father taxon and set the father on the child.
+    Edges shared by several lineages are written once, the updates are sent in batched bulk writes
     """
-    for index in range(len(ordered_taxons) - 1):
-        child_taxon = ordered_taxons[index]
-        father_taxon = ordered_taxons[index + 1]
-        father_taxon.modify(add_to_set__children=child_taxon.taxid)
+    edges = set()
+    for ordered_taxons in ordered_lineages:
+        for index in range(len(ordered_taxons) - 1):
+            edges.add((ordered_taxons[index].taxid, ordered_taxons[index + 1].taxid))
+
+    def hierarchy_ops():
+        for child_taxid, father_taxid in edges:
+            yield UpdateOne({'taxid': father_taxid}, {'$addToSet': {'children': child_taxid}})
+            yield UpdateOne({'taxid': child_taxid}, {'$set': {'parent_taxid': father_taxid}})
+
+    taxon_collection = TaxonNode._get_collection()
+    for ops in iter_batches(hierarchy_ops(), batch_size):
+        taxon_collection.bulk_write(ops, ordered=False)
+    bump_taxon_tree_version()
 
 
 def rebuild_taxon_hierarchy_from_lineages():
@@ -154,121 +203,81 @@ def rebuild_taxon_hierarchy_from_lineages():
     Rebuild the taxon hierarchy from all existing taxon_lineage data in assemblies, annotations, and organisms.
     This ensures that parent-child relationships are correctly set even if they weren't established during initial import.
     
-    Memory-efficient implementation: streams lineages and processes taxon nodes in batches to avoid loading all 20k into memory.
+    Runs entirely server-side: a single aggregation computes the children of every parent and $merge-s them into the taxon nodes,
+    then the nodes not stamped by this run have their children cleared.
+    Finally the parent_taxid of every node is derived from the rebuilt children lists.
     """
     
     print("Rebuilding taxon hierarchy from all lineages...")
     
-    # Build parent-child relationships incrementally by streaming lineages
-    # parent_taxid -> set of child_taxids
-    parent_to_children = defaultdict(set)
-    
-    # Process lineages from assemblies
-    for doc in GenomeAssembly.objects.aggregate([
-        {"$project": {"taxon_lineage": 1}},
-        {"$match": {"taxon_lineage": {"$ne": [], "$exists": True}}},
-        {"$group": {"_id": "$taxon_lineage"}}
-    ]):
-        lineage = doc["_id"]
-        # lineage is ordered from species (index 0) to root (last index)
-        for i in range(len(lineage) - 1):
-            child_taxid = lineage[i]
-            parent_taxid = lineage[i + 1]
-            parent_to_children[parent_taxid].add(child_taxid)
-    
-    # Process lineages from annotations
-    for doc in GenomeAnnotation.objects.aggregate([
-        {"$project": {"taxon_lineage": 1}},
-        {"$match": {"taxon_lineage": {"$ne": [], "$exists": True}}},
-        {"$group": {"_id": "$taxon_lineage"}}
-    ]):
-        lineage = doc["_id"]
-        for i in range(len(lineage) - 1):
-            child_taxid = lineage[i]
-            parent_taxid = lineage[i + 1]
-            parent_to_children[parent_taxid].add(child_taxid)
-    
-    # Process lineages from organisms
-    for doc in Organism.objects.aggregate([
-        {"$project": {"taxon_lineage": 1}},
-        {"$match": {"taxon_lineage": {"$ne": [], "$exists": True}}},
-        {"$group": {"_id": "$taxon_lineage"}}
-    ]):
-        lineage = doc["_id"]
-        for i in range(len(lineage) - 1):
-            child_taxid = lineage[i]
-            parent_taxid = lineage[i + 1]
-            parent_to_children[parent_taxid].add(child_taxid)
-    
-    # Convert sets to sorted lists for consistency
-    parent_to_children = {k: sorted(list(v)) for k, v in parent_to_children.items()}
-    
-    # Use raw MongoDB collection for efficient bulk updates
     taxon_collection = TaxonNode._get_collection()
-    updated_count = 0
-    batch_size = 1000
-    
-    # Process taxons that should have children (those in parent_to_children) in batches
-    parent_taxids_list = list(parent_to_children.keys())
+    # Every parent touched in this run is stamped, so stale parents can be found with an indexed query
+    rebuild_stamp = str(ObjectId())
     
-    for batch_taxids in create_batches(parent_taxids_list, batch_size):
-        # Build bulk operations for this batch
-        bulk_ops = []
-        for taxid in batch_taxids:
-            expected_children = parent_to_children[taxid]
-            bulk_ops.append(
-                UpdateOne(
-                    {'taxid': taxid},
-                    {'$set': {'children': expected_children}}
-                )
-            )
-        
-        if bulk_ops:
-            result = taxon_collection.bulk_write(bulk_ops, ordered=False)
-            updated_count += result.modified_count
-    
-    # Clear children for taxons that shouldn't have any (not in parent_to_children but currently have children)
-    # Process in batches as we find them to avoid loading all into memory
-    all_parent_taxids_set = set(parent_to_children.keys())
-    
-    # Find taxons with children that aren't in our parent list, process in batches
-    batch_taxids_to_clear = []
-    for doc in taxon_collection.find(
-        {'taxid': {'$nin': list(all_parent_taxids_set)}, 'children': {'$ne': []}},
-        {'taxid': 1}
-    ):
-        batch_taxids_to_clear.append(doc['taxid'])
-        
-        # Process batch when it reaches batch_size
-        if len(batch_taxids_to_clear) >= batch_size:
-            bulk_ops = [
-                UpdateOne(
-                    {'taxid': taxid},
-                    {'$set': {'children': []}}
-                )
-                for taxid in batch_taxids_to_clear
-            ]
-            
-            result = taxon_collection.bulk_write(bulk_ops, ordered=False)
-            updated_count += result.modified_count
-            batch_taxids_to_clear = []
+    pipeline = [
+        # lineages from assemblies, annotations and organisms
+        {"$project": {"_id": 0, "lineage": "$taxon_lineage"}},
+        {"$unionWith": {"coll": GenomeAnnotation._get_collection_name(), "pipeline": [{"$project": {"_id": 0, "lineage": "$taxon_lineage"}}]}},
+        {"$unionWith": {"coll": Organism._get_collection_name(), "pipeline": [{"$project": {"_id": 0, "lineage": "$taxon_lineage"}}]}},
+        {"$match": {"lineage.1": {"$exists": True}}},
+        # lineage is ordered from species (index 0) to root (last index)
+        {"$project": {
+            "pairs": {
+                "$map": {
+                    "input": {"$range": [0, {"$subtract": [{"$size": "$lineage"}, 1]}]},
+                    "as": "i",
+                    "in": {
+                        "child": {"$arrayElemAt": ["$lineage", "$$i"]},
+                        "parent": {"$arrayElemAt": ["$lineage", {"$add": ["$$i", 1]}]},
+                    }
+                }
+            }
+        }},
+        {"$unwind": "$pairs"},
+        {"$group": {"_id": "$pairs.parent", "children": {"$addToSet": "$pairs.child"}}},
+        # sorted lists for consistency
+        {"$project": {
+            "_id": 0,
+            "taxid": "$_id",
+            "children": {"$sortArray": {"input": "$children", "sortBy": 1}},
+            "rebuild_stamp": rebuild_stamp,
+        }},
+        {"$merge": {
+            "into": TaxonNode._get_collection_name(),
+            "on": "taxid",
+            "whenMatched": "merge",
+            "whenNotMatched": "discard",
+        }},
+    ]
+    GenomeAssembly._get_collection().aggregate(pipeline, allowDiskUse=True)
+    updated_count = taxon_collection.count_documents({'rebuild_stamp': rebuild_stamp})
     
-    # Process remaining taxids
-    if batch_taxids_to_clear:
-        bulk_ops = [
-            UpdateOne(
-                {'taxid': taxid},
-                {'$set': {'children': []}}
-            )
-            for taxid in batch_taxids_to_clear
-        ]
-        
-        result = taxon_collection.bulk_write(bulk_ops, ordered=False)
-        updated_count += result.modified_count
+    # Clear children for taxons that shouldn't have any (not stamped in this run but currently have children)
+    result = taxon_collection.update_many(
+        {'rebuild_stamp': {'$ne': rebuild_stamp}, 'children': {'$ne': []}},
+        {'$set': {'children': []}}
+    )
+    updated_count += result.modified_count
+
+    # Denormalize the parent onto each node so parent lookups hit the scalar parent_taxid index
+    parent_pipeline = pipelines_helper.taxon_parents_pipeline(TaxonNode._get_collection_name())
+    taxon_collection.aggregate(parent_pipeline, allowDiskUse=True)
     
+    bump_taxon_tree_version()
     print(f"Rebuilt taxon hierarchy: updated {updated_count} taxon nodes")
 
 
+def backfill_taxon_parents():
+    """
+    Set the parent_taxid of the taxon nodes that never got one (nodes saved before the field existed, roots of new lineages).
+    Nodes without parent are set to null, so once backfilled they are not matched again
+    """
+    pipeline = pipelines_helper.taxon_parents_pipeline(TaxonNode._get_collection_name(), {"parent_taxid": {"$exists": False}})
+    TaxonNode._get_collection().aggregate(pipeline, allowDiskUse=True)
+    bump_taxon_tree_version()
+    print("Backfilled taxon parents")
+
+
 def parse_taxons_and_organisms_from_ena_browser(xml_path: str) -> list[OrganismToProcess]:
     """
     Memory-efficient streaming parser for ENA taxonomy XML files (gzipped).
@@ -279,13 +288,17 @@ def parse_taxons_and_organisms_from_ena_browser(xml_path: str) -> list[OrganismT
     organisms = []
 
     with gzip.open(xml_path, "rb") as f:
-        # Stream everything; handle tag=taxon manually
-        context = etree.iterparse(f, events=("end",))
+        # Stream only taxon elements; top-level ones are filtered manually
+        context = etree.iterparse(
+            f,
+            events=("end",),
+            tag="taxon",
+            resolve_entities=False,
+            no_network=True,
+            huge_tree=True,
+        )
 
         for _, elem in context:
-            if elem.tag != "taxon":
-                continue
-
             parent = elem.getparent()
             if parent is None or parent.tag != "TAXON_SET":
                 # lineage/child taxons—do NOT clear them now
@@ -312,21 +325,22 @@ def parse_taxons_and_organisms_from_ena_browser(xml_path: str) -> list[OrganismT
             )
 
             # --------- Parse lineage ---------
-            lineage_elem = elem.find("lineage")
-            if lineage_elem is not None:
-                for lt in lineage_elem.findall("taxon"):
-                    lt_taxid = lt.get("taxId")
-                    if not lt_taxid or lt.get("scientificName") == "root":
-                        continue
-
-                    organism.taxon_lineage.append(lt_taxid)
-                    organism.parsed_taxon_lineage.append(
-                        TaxonNode(
-                            taxid=lt_taxid,
-                            scientific_name=lt.get("scientificName"),
-                            rank=lt.get("rank") or "other"
-                        )
+            taxon_lineage = organism.taxon_lineage
+            parsed_taxon_lineage = organism.parsed_taxon_lineage
+            for lt in _LINEAGE_TAXONS(elem):
+                lt_taxid = lt.get("taxId")
+                lt_name = lt.get("scientificName")
+                if not lt_taxid or lt_name == "root":
+                    continue
+
+                taxon_lineage.append(lt_taxid)
+                parsed_taxon_lineage.append(
+                    TaxonNode(
+                        taxid=lt_taxid,
+                        scientific_name=lt_name,
+                        rank=lt.get("rank") or "other"
                     )
+                )
 
             organisms.append(organism)
 
@@ -350,18 +364,31 @@ def get_new_organisms_taxids(taxids: list[str])->list[str]:
     return list(new_taxids)
 
 
-def handle_new_lineage(organism: OrganismToProcess):
+def get_lineage_taxon_map(taxids: Iterable[str]) -> dict[str, TaxonNode]:
+    """
+    Preload the taxon nodes (taxid, scientific name and rank) of a set of lineages in a single query
+    """
+    return {
+        taxon.taxid: taxon
+        for taxon in TaxonNode.objects(taxid__in=list(set(taxids))).only('taxid', 'scientific_name', 'rank')
+    }
+
+def handle_new_lineage(organism: OrganismToProcess, taxon_map: dict[str, TaxonNode] | None = None):
     """
     Handle the new lineage for an organism
     - organism: OrganismToProcess
+    - taxon_map: optional preloaded taxid -> TaxonNode map (see get_lineage_taxon_map), kept up to date with the saved taxons
     """
     #check if all the taxons already exists in the db and save the new ones
-    existing_taxons = TaxonNode.objects(taxid__in=organism.taxon_lineage)
-    new_taxons = set(organism.taxon_lineage) - set(existing_taxons.scalar('taxid'))
+    if taxon_map is None:
+        taxon_map = get_lineage_taxon_map(organism.taxon_lineage)
+    existing_taxons = [taxon_map[taxid] for taxid in organism.taxon_lineage if taxid in taxon_map]
+    new_taxons = set(organism.taxon_lineage) - set(taxon_map)
     if new_taxons:
         taxons_to_save = [taxon for taxon in organism.parsed_taxon_lineage if taxon.taxid in new_taxons]
         try:
-            TaxonNode.objects.insert(taxons_to_save)
+            saved_taxons = TaxonNode.objects.insert(taxons_to_save)
+            taxon_map.update({taxon.taxid: taxon for taxon in saved_taxons})
             print(f"Saved {len(taxons_to_save)} new taxons")
         except Exception as e:
             print(f"Error saving new taxons: {e}")
@@ -382,17 +409,18 @@ def handle_new_lineage(organism: OrganismToProcess):
     # No need for incremental update here since it only adds and doesn't remove stale relationships
 
 
-def process_organism(organism: OrganismToProcess, existing_organism: Organism):
+def process_organism(organism: OrganismToProcess, existing_organism: Organism, taxon_map: dict[str, TaxonNode] | None = None):
     """
     Process an organism
     - organism: OrganismToProcess
+    - taxon_map: optional preloaded taxid -> TaxonNode map passed to handle_new_lineage
     """
     payload = dict()
     payload_of_related_documents = dict()
     if existing_organism.taxon_lineage != organism.taxon_lineage:
         payload['taxon_lineage'] = organism.taxon_lineage
         payload_of_related_documents['taxon_lineage'] = organism.taxon_lineage
-        handle_new_lineage(organism)
+        handle_new_lineage(organism, taxon_map)
     if existing_organism.organism_name != organism.organism_name:
         payload['organism_name'] = organism.organism_name
         payload_of_related_documents['organism_name'] = organism.organism_name
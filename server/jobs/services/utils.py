@@ -1,5 +1,23 @@
+from typing import Iterable, Iterator
 
 def create_batches(annotations: list[object], batch_size: int=100) -> list[list[object]]:
     return [annotations[i:i+batch_size] for i in range(0, len(annotations), batch_size)]
 
+def iter_batches(items: Iterable[object], batch_size: int=100) -> Iterator[list[object]]:
+    """
+    Yield lists of batch_size items from any iterable without materializing the source
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
+def iter_scalar(queryset, field: str, batch_size: int=5000) -> Iterator[object]:
+    """
+    Stream the values of a single field from a queryset, fetching batch_size documents per round trip
+    """
+    yield from queryset.scalar(field).batch_size(batch_size).no_cache()
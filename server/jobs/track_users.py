@@ -5,7 +5,6 @@ import os
 import time
 from datetime import datetime
 from typing import Dict, List
-from collections import defaultdict
 
 from celery import shared_task
 import requests
@@ -36,12 +35,12 @@ def create_ip_fingerprint(ip: str) -> str:
     ).hexdigest()
 
 
-def parse_log_file(log_path: str) -> Dict[str, List[datetime]]:
+def parse_log_file(log_path: str) -> Dict[str, List]:
     """
-    Parse the JSON lines log file and extract IP addresses with their visit times.
-    Returns a dictionary mapping IP -> list of visit datetimes.
+    Parse the JSON lines log file and aggregate the visits of each IP address in a single pass.
+    Returns a dictionary mapping IP -> [first_visit, last_visit, visits_count].
     """
-    ip_visits = defaultdict(list)
+    ip_visits = {}
     
     if not os.path.exists(log_path):
         print(f"Log file not found: {log_path}")
@@ -64,7 +63,17 @@ def parse_log_file(log_path: str) -> Dict[str, List[datetime]]:
                     
                     # Parse ISO 8601 datetime
                     visit_time = datetime.fromisoformat(time_str.replace('Z', '+00:00'))
-                    ip_visits[ip].append(visit_time)
+                    
+                    # Keep only first/last visit and count instead of every visit time
+                    visits = ip_visits.get(ip)
+                    if visits is None:
+                        ip_visits[ip] = [visit_time, visit_time, 1]
+                        continue
+                    if visit_time < visits[0]:
+                        visits[0] = visit_time
+                    elif visit_time > visits[1]:
+                        visits[1] = visit_time
+                    visits[2] += 1
                     
                 except json.JSONDecodeError as e:
                     print(f"Error parsing JSON on line {line_num}: {e}")
@@ -149,14 +158,11 @@ def get_single_ip_country(ip: str) -> str:
     return 'Unknown'
 
 
-def update_user_stats(ip: str, country: str, visit_times: List[datetime]):
+def update_user_stats(ip: str, country: str, first_visit: datetime, last_visit: datetime, visits_count: int):
     """
     Update or create UserAnalytics document for an IP address.
     """
     fingerprint = create_ip_fingerprint(ip)
-    first_visit = min(visit_times)
-    last_visit = max(visit_times)
-    visits_count = len(visit_times)
     
     # Find existing document or create new one
     user = UserAnalytics.objects(fingerprint=fingerprint).first()
@@ -222,8 +228,8 @@ def track_unique_users_by_country():
         # Update database for each IP in the batch
         for ip in batch:
             country = ip_to_country.get(ip, 'Unknown')
-            visit_times = ip_visits[ip]
-            update_user_stats(ip, country, visit_times)
+            first_visit, last_visit, visits_count = ip_visits[ip]
+            update_user_stats(ip, country, first_visit, last_visit, visits_count)
             total_processed += 1
         
         # Rate limiting: ip-api.com free tier allows 45 requests per minute
@@ -1,23 +1,109 @@
-from celery import shared_task
-from db.models import GenomeAssembly, GenomeAnnotation,  Organism
+from celery import shared_task, group, chord
+from db.models import GenomeAssembly, GenomeAnnotation,  Organism, TaxonRankAggregate
 import os
+from helpers import file as file_helper
 from .services import assembly as assembly_service
-from .services.utils import create_batches
+from .services.utils import create_batches, iter_scalar
 from .services import stats as stats_service
 from .services import annotation as annotation_service
 from .services import taxonomy as taxonomy_service
+from .services import feature_stats as feature_stats_service
+from collections import defaultdict
+from itertools import chain
+from pymongo.operations import UpdateMany, UpdateOne
+from mongoengine import Q
 
 TMP_DIR = "/tmp"
 
 ANNOTATIONS_PATH = os.getenv('LOCAL_ANNOTATIONS_DIR')
 
+WRITE_BATCH_SIZE = 500
+
 @shared_task(name='update_taxon_stats', ignore_result=False)
 def update_taxon_stats():
     """
     Update the taxon stats for the annotations, nice and slow operation.
-    Currently only gene counts are computed
+    Currently only gene counts are computed, then averaged by taxon for the aggregates by rank endpoint
     """
     stats_service.update_taxon_gene_stats()
+    stats_service.update_taxon_rank_aggregates()
+
+
+@shared_task(name='backfill_taxon_parents', ignore_result=False)
+def backfill_taxon_parents():
+    """
+    Set parent_taxid on the taxon nodes missing it, dispatched once when the worker starts
+    """
+    taxonomy_service.backfill_taxon_parents()
+
+
+@shared_task(name='seed_taxon_rank_aggregates', ignore_result=False)
+def seed_taxon_rank_aggregates():
+    """
+    Compute the taxon rank aggregates if none are stored yet, dispatched once when the worker starts
+    so the aggregates endpoint has rows before the first update_records run
+    """
+    if TaxonRankAggregate.objects().only('id').first():
+        return
+    stats_service.update_taxon_rank_aggregates()
+
+
+@shared_task(name='update_db_stats', ignore_result=False)
+def update_db_stats():
+    """
+    Update the db counts and delete the orphan records
+    """
+    stats_service.update_db_stats()
+
+FEATURE_STATS_BATCH_SIZE = 50
+
+@shared_task(name='update_feature_stats', ignore_result=False)
+def update_feature_stats():
+    """
+    Compute the features statistics of the annotations missing them or computed with an older schema version.
+    Annotations already on the new schema (gene_category_stats present and no older schema_version) are skipped.
+    Annotations are split in batches parsed by independent worker tasks, taxon stats are updated once all batches are done.
+    On-demand backfill triggered from the jobs API, not scheduled: annotations whose file is missing or fails to parse
+    never get current statistics and would be picked up again on every run
+    """
+    outdated_query = (
+        Q(features_statistics__gene_category_stats__exists=False)
+        | Q(features_statistics__schema_version__lt=feature_stats_service.CURRENT_SCHEMA_VERSION)
+    )
+    annotation_ids = list(iter_scalar(GenomeAnnotation.objects(outdated_query), 'annotation_id'))
+    if not annotation_ids:
+        print("No annotations with missing or outdated features statistics found")
+        return
+    batches = create_batches(annotation_ids, FEATURE_STATS_BATCH_SIZE)
+    print(f"Computing features statistics for {len(annotation_ids)} annotations in {len(batches)} batches")
+    chord(group(compute_features_statistics_batch.s(batch) for batch in batches))(update_taxon_stats.si())
+
+
+@shared_task(name='compute_features_statistics_batch', ignore_result=False)
+def compute_features_statistics_batch(annotation_ids: list[str]) -> int:
+    """
+    Compute the features statistics for a batch of annotations and save them with one bulk write
+    - annotation_ids: list of annotation ids to process
+    """
+    bulk_ops = []
+    for annotation in GenomeAnnotation.objects(annotation_id__in=annotation_ids).only('annotation_id', 'indexed_file_info', 'features_statistics.schema_version'):
+        features_statistics = annotation.features_statistics
+        if features_statistics and features_statistics.schema_version == feature_stats_service.CURRENT_SCHEMA_VERSION:
+            continue #already updated, e.g. by a previous run of this batch
+        try:
+            #annotations without indexed file info raise here, skip them instead of failing the whole batch
+            file_path = file_helper.get_annotation_file_path(annotation)
+            if not os.path.exists(file_path):
+                print(f"Annotation file not found at {file_path}, skipping...")
+                continue
+            feature_stats = feature_stats_service.compute_features_statistics(file_path)
+        except Exception as e:
+            print(f"Error computing features statistics for {annotation.annotation_id}: {e}")
+            continue
+        bulk_ops.append(UpdateOne({"annotation_id": annotation.annotation_id}, {"$set": {"features_statistics": feature_stats.to_mongo()}}))
+    if bulk_ops:
+        GenomeAnnotation._get_collection().bulk_write(bulk_ops, ordered=False)
+    return len(bulk_ops)
 
 
 def fetch_new_organisms_from_assembly_taxids(assembly_taxids: list[str]):
@@ -37,14 +123,26 @@ def fetch_new_organisms_from_assembly_taxids(assembly_taxids: list[str]):
     if not saved_taxids:
         return 
     
-    taxonomy_service.save_taxons([o for o in new_organisms_to_process if o.taxon_id in saved_taxids]) #save the new taxons
+    saved_taxids = set(saved_taxids)
+    #organisms just saved, kept in memory instead of reading them back from the db
+    saved_organisms = [o for o in new_organisms_to_process if o.taxon_id in saved_taxids]
+    taxonomy_service.save_taxons(saved_organisms) #save the new taxons
 
     #update assemblies with new organism data
     # Note: Hierarchy will be rebuilt from all lineages by rebuild_taxon_hierarchy_from_lineages()
-    saved_organisms = Organism.objects(taxid__in=saved_taxids)
+    # group taxids by identical payload to send one update per distinct lineage and name
+    taxids_by_payload = defaultdict(list)
     for organism in saved_organisms:
-        payload = dict(taxon_lineage=organism.taxon_lineage, organism_name=organism.organism_name)
-        GenomeAssembly.objects(taxid=organism.taxid).update(**payload)
+        taxids_by_payload[(tuple(organism.taxon_lineage), organism.organism_name)].append(organism.taxon_id)
+    bulk_ops = [
+        UpdateMany(
+            {"taxid": {"$in": taxids}},
+            {"$set": {"taxon_lineage": list(taxon_lineage), "organism_name": organism_name}}
+        )
+        for (taxon_lineage, organism_name), taxids in taxids_by_payload.items()
+    ]
+    if bulk_ops:
+        GenomeAssembly._get_collection().bulk_write(bulk_ops, ordered=False)
 
 
 def update_stale_annotations(assembly_taxids: list[str]) -> None:
@@ -80,17 +178,25 @@ def update_stale_annotations(assembly_taxids: list[str]) -> None:
     related_assembly_accessions = list(annotations_by_assembly.keys())
     assembly_map = assembly_service.build_assembly_lookup(related_assembly_accessions)
 
+    # group annotation ids by identical payload to send one update per distinct taxonomy
+    annotation_ids_by_payload = defaultdict(list)
     for acc, ann_ids in annotations_by_assembly.items():
         assembly = assembly_map.get(acc)
         if not assembly:
             assemblies_not_found.add(acc)
             continue
-        update_payload = dict(
-            taxid=assembly.taxid,
-            organism_name=assembly.organism_name,
-            taxon_lineage=assembly.taxon_lineage
+        payload_key = (assembly.taxid, assembly.organism_name, tuple(assembly.taxon_lineage))
+        annotation_ids_by_payload[payload_key].extend(ann_ids)
+
+    bulk_ops = [
+        UpdateMany(
+            {"annotation_id": {"$in": ann_ids}},
+            {"$set": {"taxid": taxid, "organism_name": organism_name, "taxon_lineage": list(taxon_lineage)}}
         )
-        GenomeAnnotation.objects(annotation_id__in=ann_ids).update(**update_payload)
+        for (taxid, organism_name, taxon_lineage), ann_ids in annotation_ids_by_payload.items()
+    ]
+    if bulk_ops:
+        GenomeAnnotation._get_collection().bulk_write(bulk_ops, ordered=False, bypass_document_validation=True)
 
     if assemblies_not_found:
         annotation_service.delete_annotations(
@@ -99,19 +205,40 @@ def update_stale_annotations(assembly_taxids: list[str]) -> None:
         )
 
 
-def update_records_with_empty_taxon_lineage_fallback(model: GenomeAssembly | GenomeAnnotation):
+def update_records_with_empty_taxon_lineage_fallback(*models: type[GenomeAssembly] | type[GenomeAnnotation]):
     """
-    Update the documents with empty taxon lineage fallback
-    - model: GenomeAssembly | GenomeAnnotation
+    Update the documents with empty taxon lineage fallback, resolving the organism data server side
+    - models: GenomeAssembly and/or GenomeAnnotation
     """
-    documents_with_empty_taxon_lineage = model.objects(taxon_lineage=[])
-    if documents_with_empty_taxon_lineage.count() > 0:
-        related_taxids = set(documents_with_empty_taxon_lineage.scalar('taxid'))
-        related_organisms = Organism.objects(taxid__in=list(related_taxids))
-        for organism in related_organisms:
-            if organism.taxon_lineage:
-                update_payload = dict(taxon_lineage=organism.taxon_lineage, organism_name=organism.organism_name)
-                model.objects(taxid=organism.taxid).update(**update_payload)
+    pipeline = [
+        {"$match": {"taxon_lineage": {"$size": 0}}},
+        {"$group": {"_id": "$taxid"}},
+        {"$lookup": {
+            "from": Organism._get_collection_name(),
+            "localField": "_id",
+            "foreignField": "taxid",
+            "as": "organism"
+        }},
+        {"$unwind": "$organism"},
+        {"$match": {"organism.taxon_lineage.0": {"$exists": True}}},
+        {"$project": {
+            "_id": 0,
+            "taxid": "$_id",
+            "taxon_lineage": "$organism.taxon_lineage",
+            "organism_name": "$organism.organism_name"
+        }}
+    ]
+    for model in models:
+        collection = model._get_collection()
+        bulk_ops = [
+            UpdateMany(
+                {"taxid": row["taxid"]},
+                {"$set": {"taxon_lineage": row["taxon_lineage"], "organism_name": row["organism_name"]}}
+            )
+            for row in collection.aggregate(pipeline, allowDiskUse=True)
+        ]
+        if bulk_ops:
+            collection.bulk_write(bulk_ops, ordered=False)
     
 
 def update_taxonomy_from_ebi():
@@ -119,25 +246,43 @@ def update_taxonomy_from_ebi():
     Update the taxonomy from EBI
     """
     #UPDATE ORGANISMS
-    # Stream taxids instead of loading all into memory
-    all_taxids = Organism.objects().scalar('taxid')
-    batches = create_batches(list(all_taxids), 5000)
-    for batch in batches:
+    # Writes are accumulated per collection and flushed in bulk
+    pending_ops = {Organism: [], GenomeAssembly: [], GenomeAnnotation: []}
+
+    def flush_ops(min_size: int=0):
+        for model, ops in pending_ops.items():
+            if ops and len(ops) >= min_size:
+                model._get_collection().bulk_write(ops, ordered=False)
+                ops.clear()
+
+    # The taxids are materialized up front, a cursor left open across the slow EBI downloads would time out
+    taxids = list(iter_scalar(Organism.objects(), 'taxid'))
+    for batch in create_batches(taxids, 5000):
         organisms_to_process = taxonomy_service.fetch_new_organisms(batch, TMP_DIR)
         existing_organisms_map = {
-            organism.taxid: organism for organism in Organism.objects(taxid__in=batch)
+            organism.taxid: organism for organism in Organism.objects(taxid__in=batch).only('taxid', 'taxon_lineage', 'organism_name', 'common_name')
         }
+        #preload once per batch the taxons of the lineages that changed
+        changed_lineages = [
+            organism.taxon_lineage for organism in organisms_to_process
+            if organism.taxon_lineage and organism.taxon_id in existing_organisms_map
+            and existing_organisms_map[organism.taxon_id].taxon_lineage != organism.taxon_lineage
+        ]
+        taxon_map = taxonomy_service.get_lineage_taxon_map(chain(*changed_lineages)) if changed_lineages else {}
         for organism in organisms_to_process:
             if not organism.taxon_lineage or organism.taxon_id not in existing_organisms_map:
                 continue # broken organism, skip, try next iteration
             existing_organism = existing_organisms_map[organism.taxon_id]
             #check what changed and update accordingly
-            payload, payload_of_related_documents = taxonomy_service.process_organism(organism, existing_organism)
+            payload, payload_of_related_documents = taxonomy_service.process_organism(organism, existing_organism, taxon_map)
             if payload:
-                existing_organism.modify(**payload)
+                pending_ops[Organism].append(UpdateOne({"taxid": organism.taxon_id}, {"$set": payload}))
             if payload_of_related_documents:
-                GenomeAssembly.objects(taxid=organism.taxon_id).update(**payload_of_related_documents) #update the assemblies related to the organism
-                GenomeAnnotation.objects(taxid=organism.taxon_id).update(**payload_of_related_documents) #update the annotations related to the organism
+                #update the assemblies and annotations related to the organism
+                pending_ops[GenomeAssembly].append(UpdateMany({"taxid": organism.taxon_id}, {"$set": payload_of_related_documents}))
+                pending_ops[GenomeAnnotation].append(UpdateMany({"taxid": organism.taxon_id}, {"$set": payload_of_related_documents}))
+            flush_ops(WRITE_BATCH_SIZE)
+    flush_ops()
 
 
 @shared_task(name='update_records', ignore_result=False)
@@ -149,16 +294,15 @@ def update_records():
     - Update db counts and taxon gene counts stats
     """
     #UPDATE ASSEMBLIES FROM NCBI
-    assembly_accessions = list(GenomeAssembly.objects().scalar('assembly_accession'))
-    if not assembly_accessions:
+    if not GenomeAssembly.objects().only('id').first():
         print("No assemblies found, skipping update")
         return
-    assembly_service.update_assemblies_from_ncbi(assembly_accessions, TMP_DIR, 1000)
-    
-    #free up memory
-    del assembly_accessions
+    # materialized up front, a cursor left open across the slow NCBI calls would time out
+    accessions = list(iter_scalar(GenomeAssembly.objects(), 'assembly_accession'))
+    assembly_service.update_assemblies_from_ncbi(accessions, TMP_DIR, 1000)
+    del accessions
 
-    assembly_taxids = list(set(GenomeAssembly.objects().scalar('taxid')))
+    assembly_taxids = list(set(iter_scalar(GenomeAssembly.objects(), 'taxid')))
     if not assembly_taxids:
         print("No assembly taxids found, skipping taxonomy updates")
         return
@@ -173,8 +317,7 @@ def update_records():
     del assembly_taxids
 
     #FALLBACK UPDATE FOR ASSEMBLIES AND ANNOTATIONS WITH EMPTY TAXON LINEAGE
-    update_records_with_empty_taxon_lineage_fallback(GenomeAssembly)
-    update_records_with_empty_taxon_lineage_fallback(GenomeAnnotation)
+    update_records_with_empty_taxon_lineage_fallback(GenomeAssembly, GenomeAnnotation)
 
     #UPDATE ALL TAXONOMY FROM EBI
     update_taxonomy_from_ebi()
@@ -185,9 +328,12 @@ def update_records():
     taxonomy_service.rebuild_taxon_hierarchy_from_lineages()
 
     #UPDATE DB COUNTS AND TAXON GENE COUNTS STATS
-    # This will:
+    # Dispatched as independent tasks so they can run on separate workers and this task returns.
+    # update_db_stats will:
     # 1. Update taxon counts (annotations_count, assemblies_count, organisms_count)
     # 2. Delete taxons without annotations
     # 3. Update parent taxons to remove deleted taxids from their children lists (via pull_all__children)
-    stats_service.update_db_stats()
-    stats_service.update_taxon_gene_stats()
+    # update_taxon_stats writes the gene stats of the taxon nodes and rebuilds the TaxonRankAggregate rows,
+    # neither depends on the counts. The rank aggregates $lookup taxon_node while update_db_stats may be deleting nodes,
+    # but only nodes without annotations are deleted, and those produce no aggregate rows either way
+    group(update_db_stats.si(), update_taxon_stats.si()).apply_async()
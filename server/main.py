@@ -1,4 +1,5 @@
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from db.database import connect_to_db, close_db_connection
 from celery_app.celery_utils import create_celery
@@ -6,7 +7,8 @@ from api.router import router as api_router
 import os
 
 def create_app() -> FastAPI:
-    app = FastAPI(title="Annotrieve API (FastAPI)")
+    # orjson serializes the large paginated and aggregated payloads much faster than the stdlib json
+    app = FastAPI(title="Annotrieve API (FastAPI)", default_response_class=ORJSONResponse)
 
     # Configure CORS for public research API
     # Allows access from:
@@ -0,0 +1,15 @@
+from fastapi import HTTPException
+import os
+import secrets
+
+# read once at import, the key does not change while the app is running
+_EXPECTED_AUTH_KEY = os.getenv('AUTH_KEY', '').encode()
+
+def validate_auth_key(auth_key: str | None) -> None:
+    """
+    Validate authentication key using constant-time comparison to prevent timing attacks.
+    
+    Raises HTTPException with 401 status if key is invalid or no key is configured.
+    """
+    if not _EXPECTED_AUTH_KEY or not auth_key or not secrets.compare_digest(auth_key.encode(), _EXPECTED_AUTH_KEY):
+        raise HTTPException(status_code=401, detail="Unauthorized")
@@ -12,8 +12,11 @@ def get_country_frequencies() -> Dict[str, int]:
     fingerprints per country to get the number of unique users.
     """
     try:
-        results = UserAnalytics.objects().item_frequencies('country')
-        return results
+        pipeline = [
+            {"$group": {"_id": "$country", "count": {"$sum": 1}}}
+        ]
+        cursor = UserAnalytics._get_collection().aggregate(pipeline, allowDiskUse=True, hint=[('country', 1)])
+        return {row["_id"]: row["count"] for row in cursor}
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching country frequencies: {e}")
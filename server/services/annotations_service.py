@@ -6,13 +6,14 @@ from helpers import pysam_helper
 from helpers import constants as constants_helper
 from helpers import annotation as annotation_helper
 from helpers import feature_stats as feature_stats_helper
-from helpers import pipelines as pipelines_helper
-from db.models import GenomeAnnotation, AnnotationError, AnnotationSequenceMap, TaxonNode
+from services._auth import validate_auth_key
+from db.models import GenomeAnnotation, AnnotationError, AnnotationSequenceMap, TaxonNode, TaxonRankAggregate
 from fastapi.responses import StreamingResponse
 from fastapi import HTTPException, BackgroundTasks
 from typing import Optional, Dict, Any
 import os
 from datetime import datetime
+from functools import lru_cache
 from db.embedded_documents import GFFStats
 
 def get_annotations(args: dict, field: str = None, response_type: str = 'metadata', background_tasks: Optional[BackgroundTasks] = None):
@@ -21,15 +22,16 @@ def get_annotations(args: dict, field: str = None, response_type: str = 'metadat
         offset = args.pop('offset', 0)
         fields = args.pop('fields', None)
         annotations = annotation_helper.get_annotation_records(**args)
-        total = annotations.count()
         if response_type == 'frequencies':
             return query_visitors_helper.get_frequencies(annotations, field, type='annotation')
         elif response_type == 'tsv':
             return stream_annotation_tsv(annotations)
         else:
+            #only the paginated metadata response needs the total
+            total = response_helper.count_queryset(annotations)
             if fields:
                 annotations = annotations.only(*fields.split(',') if isinstance(fields, str) else fields)
-            return response_helper.json_response_with_pagination(annotations, total, offset, limit)
+            return response_helper.raw_json_response_with_pagination(annotations, total, offset, limit)
 
     except HTTPException as e:
         raise e
@@ -37,18 +39,43 @@ def get_annotations(args: dict, field: str = None, response_type: str = 'metadat
         raise HTTPException(status_code=500, detail=f"Error fetching annotations: {e}")
 
 TSV_BUFFER_SIZE = 5000
+TSV_CHUNK_SIZE = 64 * 1024 #bytes of joined rows per yielded chunk
+TSV_CURSOR_BATCH_SIZE = 2000
+
+#precompiled at import time: header, projected fields and their (top level key, nested key) paths
+_TSV_KEYS = list(constants_helper.FIELD_TSV_MAP.keys())
+_TSV_FIELDS = list(constants_helper.FIELD_TSV_MAP.values())
+_TSV_HEADER = "\t".join(_TSV_KEYS) + "\n"
+_TSV_PATHS = [tuple(field.split('__')) for field in _TSV_FIELDS]
+
+def _fmt(value) -> str:
+    return "" if value is None else value if type(value) is str else str(value)
+
+def _tsv_values(document: dict):
+    for path in _TSV_PATHS:
+        value = document.get(path[0])
+        if len(path) > 1:
+            value = value.get(path[1]) if isinstance(value, dict) else None
+        yield value
 
 def stream_annotation_tsv(annotations):
     def row_iterator():
-        header = "\t".join(constants_helper.FIELD_TSV_MAP.keys()) + "\n"
-        yield header
+        yield _TSV_HEADER
+        fmt = _fmt
+        join = "\t".join
+        tsv_values = _tsv_values
         buffer: list[str] = []
-        for annotation in annotations.scalar(*constants_helper.FIELD_TSV_MAP.values()):
-            row = "\t".join("" if value is None else str(value) for value in annotation) + "\n"
+        buffered_size = 0
+        #raw documents with only the exported fields, no document instantiation per row
+        cursor = annotations.only(*_TSV_FIELDS).as_pymongo().batch_size(TSV_CURSOR_BATCH_SIZE).no_cache()
+        for annotation in cursor:
+            row = join(map(fmt, tsv_values(annotation))) + "\n"
             buffer.append(row)
-            if len(buffer) >= TSV_BUFFER_SIZE:
+            buffered_size += len(row)
+            if buffered_size >= TSV_CHUNK_SIZE:
                 yield "".join(buffer)
                 buffer.clear()
+                buffered_size = 0
         if buffer:
             yield "".join(buffer)
 
@@ -61,13 +88,17 @@ def stream_annotation_tsv(annotations):
     )
 
 def get_annotation_metadata(md5_checksum):
-    annotation = GenomeAnnotation.objects(annotation_id=md5_checksum).exclude('id').first()
+    annotation = GenomeAnnotation._get_collection().find_one({"annotation_id": md5_checksum}, {"_id": 0})
     if not annotation:
         raise HTTPException(status_code=404, detail=f"Annotation {md5_checksum} not found")
-    return annotation.to_mongo().to_dict()
+    return annotation
+
+#the file path of an annotation is built from the bgzipped path only
+ANNOTATION_FILE_FIELDS = ('indexed_file_info.bgzipped_path',)
 
-def get_annotation(md5_checksum):
-    annotation = GenomeAnnotation.objects(annotation_id=md5_checksum).first()
+def get_annotation(md5_checksum, only: tuple[str, ...] = None):
+    annotations = GenomeAnnotation.objects(annotation_id=md5_checksum)
+    annotation = (annotations.only(*only) if only else annotations).first()
     if not annotation:
         raise HTTPException(status_code=404, detail=f"Annotation {md5_checksum} not found")
     return annotation
@@ -78,10 +109,9 @@ def update_annotation_stats(md5_checksum, payload):
     """
     if not payload:
         raise HTTPException(status_code=400, detail="No payload provided")
-    auth_key = payload.get('auth_key')
-    if auth_key != os.getenv('AUTH_KEY'):
-        raise HTTPException(status_code=401, detail="Unauthorized")
-    annotation = get_annotation(md5_checksum)
+    validate_auth_key(payload.get('auth_key'))
+    #only the primary key is needed to modify the document
+    annotation = get_annotation(md5_checksum, only=('annotation_id',))
     gene_stats, transcript_stats = annotation_helper.map_to_stats(payload.get('features_statistics'))
     gff_stats = GFFStats(gene_category_stats=gene_stats if gene_stats else {}, transcript_type_stats=transcript_stats if transcript_stats else {})
     annotation.modify(features_statistics=gff_stats)
@@ -97,12 +127,23 @@ def get_mapped_regions(md5_checksum, offset_param, limit_param):
 
 def get_contigs(md5_checksum):
     try:
-        annotation = get_annotation(md5_checksum)
+        annotation = get_annotation(md5_checksum, only=ANNOTATION_FILE_FIELDS)
         file_path = file_helper.get_annotation_file_path(annotation)
         if not os.path.exists(file_path):
             raise HTTPException(status_code=404, detail=f"Annotation {md5_checksum} not found")
+        def stream_buffered_contigs():
+            #sync iterators are consumed from a threadpool, buffering keeps the number of thread hops low
+            buffer: list[str] = []
+            for contig in pysam_helper.stream_contigs(file_path):
+                buffer.append(contig)
+                if len(buffer) >= TSV_BUFFER_SIZE:
+                    yield "".join(buffer)
+                    buffer.clear()
+            if buffer:
+                yield "".join(buffer)
+
         return StreamingResponse(
-            pysam_helper.stream_contigs(file_path), 
+            stream_buffered_contigs(), 
             media_type='text/plain', 
             headers={
                 "Content-Disposition": f'attachment; filename="{md5_checksum}_contigs.txt"',
@@ -113,9 +154,45 @@ def get_contigs(md5_checksum):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching contigs: {e}")
 
+EMPTY_FEATURES_VOCABULARY = (frozenset(), frozenset(), frozenset())
+
+class _FeaturesSummaryNotComputed(Exception):
+    """
+    Raised by the cached lookup when the features summary is missing, lru_cache does not cache raised exceptions
+    """
+
+@lru_cache(maxsize=1024)
+def _get_cached_features_vocabulary(md5_checksum: str) -> tuple[frozenset[str], frozenset[str], frozenset[str]]:
+    annotation = GenomeAnnotation._get_collection().find_one(
+        {"annotation_id": md5_checksum},
+        {"features_summary.biotypes": 1, "features_summary.types": 1, "features_summary.sources": 1, "_id": 0}
+    )
+    if not annotation:
+        raise HTTPException(status_code=404, detail=f"Annotation {md5_checksum} not found")
+    features_summary = annotation.get("features_summary") or {}
+    vocabulary = (
+        frozenset(features_summary.get("biotypes") or []),
+        frozenset(features_summary.get("types") or []),
+        frozenset(features_summary.get("sources") or []),
+    )
+    if not any(vocabulary):
+        raise _FeaturesSummaryNotComputed()
+    return vocabulary
+
+def get_features_vocabulary(md5_checksum: str) -> tuple[frozenset[str], frozenset[str], frozenset[str]]:
+    """
+    Biotypes, feature types and feature sources of an annotation as sets.
+    Cached per annotation id, the annotation id is the md5 of the file so its features summary never changes once computed.
+    Empty vocabularies are not cached, the summary may be computed later
+    """
+    try:
+        return _get_cached_features_vocabulary(md5_checksum)
+    except _FeaturesSummaryNotComputed:
+        return EMPTY_FEATURES_VOCABULARY
+
 def stream_annotation_tabix(md5_checksum:str, region:str=None, start:int=None, end:int=None, feature_type:str=None, feature_source:str=None, biotype:str=None):
     try:
-        annotation = get_annotation(md5_checksum)
+        annotation = get_annotation(md5_checksum, only=ANNOTATION_FILE_FIELDS)
         file_path = file_helper.get_annotation_file_path(annotation)
         if not os.path.exists(file_path):
             raise HTTPException(status_code=404, detail=f"Annotation file not found at {file_path}")
@@ -133,12 +210,14 @@ def stream_annotation_tabix(md5_checksum:str, region:str=None, start:int=None, e
         seq_id = annotation_helper.resolve_sequence_id(region, md5_checksum, file_path) if region else None
 
         #check if biotype, feature_type and feature_source are valid values
-        if biotype and biotype not in annotation.features_summary.biotypes:
-            raise HTTPException(status_code=400, detail=f"Invalid biotype: {biotype}, expected values are: {annotation.features_summary.biotypes}")
-        if feature_type and feature_type not in annotation.features_summary.types:
-            raise HTTPException(status_code=400, detail=f"Invalid feature type: {feature_type}, expected values are: {annotation.features_summary.types}")
-        if feature_source and feature_source not in annotation.features_summary.sources:
-            raise HTTPException(status_code=400, detail=f"Invalid feature source: {feature_source}, expected values are: {annotation.features_summary.sources}")
+        if biotype or feature_type or feature_source:
+            biotypes, types, sources = get_features_vocabulary(md5_checksum)
+            if biotype and biotype not in biotypes:
+                raise HTTPException(status_code=400, detail=f"Invalid biotype: {biotype}, expected values are: {sorted(biotypes)}")
+            if feature_type and feature_type not in types:
+                raise HTTPException(status_code=400, detail=f"Invalid feature type: {feature_type}, expected values are: {sorted(types)}")
+            if feature_source and feature_source not in sources:
+                raise HTTPException(status_code=400, detail=f"Invalid feature source: {feature_source}, expected values are: {sorted(sources)}")
 
         def stream_buffered_gff():
             buffer: list[str] = []
@@ -163,7 +242,7 @@ def stream_annotation_tabix(md5_checksum:str, region:str=None, start:int=None, e
 def get_annotation_errors(offset_param=0, limit_param=20):
     try:
         errors = AnnotationError.objects()
-        count = errors.count()
+        count = response_helper.count_queryset(errors)
         offset, limit = params_helper.handle_pagination_params(offset_param, limit_param, count)
         return response_helper.json_response_with_pagination(errors, count, offset, limit)
     except Exception as e:
@@ -205,6 +284,15 @@ def get_transcript_stats_summary(commons: Dict[str, Any] = None, payload: Dict[s
     return feature_stats_helper.get_transcript_stats_summary(annotations)
 
 
+def get_stats_summary_bundle(commons: Dict[str, Any] = None, payload: Dict[str, Any] = None):
+    """
+    Get gene and transcript stats summaries in one request, the params and the annotations query are built once
+    """
+    params = params_helper.handle_request_params(commons or {}, payload or {})
+    annotations = annotation_helper.get_annotation_records(**params)
+    return feature_stats_helper.get_stats_summary_bundle(annotations)
+
+
 def get_transcript_type_details(transcript_type: str, commons: Dict[str, Any] = None, payload: Dict[str, Any] = None):
     """
     Get details for a specific transcript type
@@ -224,24 +312,24 @@ def get_transcript_type_metric_values(transcript_type: str, metric: str, include
     return feature_stats_helper.get_transcript_type_metric_values(transcript_type, metric, annotations, include_annotations)
 
 
+#column order of the rows consumed by the frontend, the annotations count comes last
+TAXON_RANK_AGGREGATE_FIELDS = [
+    "taxid",
+    "taxon_name",
+    "avg_coding_genes_count",
+    "avg_non_coding_genes_count",
+    "avg_pseudogenes_count",
+    "annotations_count",
+]
+
 def get_annotations_aggregates_by_taxon_rank(rank: str):
     """
     Get annotations aggregates by taxon at the given rank. Returns one record per taxon
     at that rank (e.g. ~20 for rank "class") with average coding/non_coding/pseudogene
-    counts and annotation count.
-    """
-    cursor = GenomeAnnotation.objects.aggregate(pipelines_helper.aggregate_by_taxon_pipeline(rank))
-    fields = [
-        "taxid",
-        "taxon_name",
-        "annotations_count",
-        "avg_coding_genes_count",
-        "avg_non_coding_genes_count",
-        "avg_pseudogenes_count",
-
-    ]
-    values = [[*record.values()] for record in cursor]
-    return {
-        "fields": fields,
-        "rows": values,
-    }
+    counts and annotation count. Rows are precomputed by the taxon stats job.
+    """
+    projection = {field: 1 for field in TAXON_RANK_AGGREGATE_FIELDS}
+    projection["_id"] = 0
+    cursor = TaxonRankAggregate._get_collection().find({"rank": rank}, projection).sort("taxon_name", 1)
+    rows = ([record.get(field) for field in TAXON_RANK_AGGREGATE_FIELDS] for record in cursor)
+    return response_helper.stream_rows_json(TAXON_RANK_AGGREGATE_FIELDS, rows)
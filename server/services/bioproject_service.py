@@ -12,7 +12,7 @@ def get_bioprojects(filter: str = None, offset: int = 0, limit: int = 20, sort_b
     if sort_by:
         sort = f"-{sort_by}" if sort_order == 'desc' else sort_by
         bioprojects = bioprojects.order_by(sort)
-    bioprojects = bioprojects.exclude('id')
+    bioprojects = bioprojects.exclude('id', 'rebuild_stamp')
     total = bioprojects.count()
     return response_helper.json_response_with_pagination(bioprojects, total, offset, limit)
 
@@ -21,7 +21,7 @@ def get_bioproject(accession: str):
     """
     Fetch a single BioProject by accession.
     """
-    bioproject = BioProject.objects(accession=accession).exclude('id').first()
+    bioproject = BioProject.objects(accession=accession).exclude('id', 'rebuild_stamp').first()
     if not bioproject:
         raise HTTPException(status_code=404, detail=f"Bioproject {accession} not found")
     return bioproject
@@ -1,5 +1,6 @@
 from typing import Optional
-from db.models import TaxonNode
+import time
+from db.models import TaxonNode, TaxonTreeVersion, TAXON_TREE_VERSION_NAME
 from helpers import response as response_helper, query_visitors as query_visitors_helper
 from fastapi import HTTPException
 from fastapi.responses import StreamingResponse
@@ -10,114 +11,185 @@ def get_taxon_nodes(filter: str = None, rank: str = None, offset: int = 0, limit
         query['rank'] = rank
     if taxids:
         query['taxid__in'] = taxids.split(',') if isinstance(taxids, str) else taxids
-    taxon_nodes = TaxonNode.objects(**query) if query else TaxonNode.objects()
+    taxon_nodes = (TaxonNode.objects(**query) if query else TaxonNode.objects()).exclude('rebuild_stamp')
     if filter:
         q_filter = query_visitors_helper.taxon_query(filter) if filter else None
         taxon_nodes = taxon_nodes.filter(q_filter)
     if sort_by:
         sort = '-' + sort_by if sort_order == 'desc' else sort_by
         taxon_nodes = taxon_nodes.order_by(sort)
-    taxon_nodes = taxon_nodes.exclude('id').skip(offset).limit(limit).as_pymongo()
-    return response_helper.json_response_with_pagination(taxon_nodes, taxon_nodes.count(), offset, limit)
+    # larger limits are clamped rather than rejected, clients paging the taxons with bigger pages keep working
+    try:
+        limit = min(int(limit), response_helper.MAX_PAGINATION_LIMIT)
+    except (TypeError, ValueError):
+        pass #left to the pagination helper, which falls back to the default limit
+    # count on the filtered queryset once, the pagination helper applies skip/limit to the page query only
+    return response_helper.json_response_with_pagination(taxon_nodes, response_helper.count_queryset(taxon_nodes), offset, limit)
 
 def get_rank_frequencies():
-    ranks = TaxonNode.objects().item_frequencies('rank')
-    return ranks
+    pipeline = [
+        {"$group": {"_id": "$rank", "count": {"$sum": 1}}}
+    ]
+    return {row["_id"]: row["count"] for row in TaxonNode._get_collection().aggregate(pipeline)}
 
-def get_taxon_node(taxid: str):
-    taxon_node = TaxonNode.objects(taxid=taxid).exclude('id').first()
+#internal fields kept out of the taxon responses
+TAXON_EXCLUDED_FIELDS = {"_id": 0, "rebuild_stamp": 0}
+
+def get_taxon_node(taxid: str) -> dict:
+    taxon_node = TaxonNode._get_collection().find_one({"taxid": taxid}, TAXON_EXCLUDED_FIELDS)
     if not taxon_node:
         raise HTTPException(status_code=404, detail=f"Taxon node {taxid} not found")
     return taxon_node
 
 def get_taxon_node_children(taxid: str):
     taxon_node = get_taxon_node(taxid)
-    children = TaxonNode.objects(taxid__in=taxon_node['children']).exclude('id').as_pymongo()
-    return response_helper.json_response_with_pagination(children, children.count(), 0, len(children))
+    # the children list is already bounded, fetch it once and return it as a single page
+    children = list(TaxonNode._get_collection().find({"taxid": {"$in": taxon_node.get('children', [])}}, TAXON_EXCLUDED_FIELDS))
+    return {
+        'total': len(children),
+        'offset': 0,
+        'limit': len(children),
+        'results': children
+    }
 
 def get_ancestors(taxid: str):
-    taxon = get_taxon_node(taxid)
-    ancestors = [taxon.to_mongo().to_dict()]
-    parent = TaxonNode.objects(children=taxid).exclude('id').first()
-    while parent:
-        ancestors.append(parent.to_mongo().to_dict())
-        parent = TaxonNode.objects(children=parent.taxid).exclude('id').first()
-    ancestors.reverse()
+    # climb the parent_taxid -> taxid relation server side in a single query, each level is a point lookup on the unique taxid index
+    pipeline = [
+        {"$match": {"taxid": taxid}},
+        {"$graphLookup": {
+            "from": TaxonNode._get_collection_name(),
+            "startWith": "$parent_taxid",
+            "connectFromField": "parent_taxid",
+            "connectToField": "taxid",
+            "as": "ancestors",
+            "depthField": "depth"
+        }},
+        # depth 0 is the direct parent, sort from the root down to the taxon
+        {"$set": {"ancestors": {"$sortArray": {"input": "$ancestors", "sortBy": {"depth": -1}}}}},
+        {"$project": {
+            **TAXON_EXCLUDED_FIELDS,
+            **{f"ancestors.{field}": 0 for field in TAXON_EXCLUDED_FIELDS},
+            "ancestors.depth": 0,
+        }}
+    ]
+    taxon = next(TaxonNode._get_collection().aggregate(pipeline), None)
+    if not taxon:
+        raise HTTPException(status_code=404, detail=f"Taxon node {taxid} not found")
+    ancestors = taxon.pop("ancestors")
+    ancestors.append(taxon)
     return {
         "results": ancestors,
         "total": len(ancestors)
     }
 
+CELLULAR_ORGANISMS_TAXID = "131567"
+
+#tab and line breaks would break the TSV rows of free text fields
+_TSV_TRANS = str.maketrans({"\t": " ", "\n": " ", "\r": " "})
+
+FLATTENED_TREE_FIELDS = [
+    "taxid",
+    "parent_taxid",
+    "scientific_name",
+    "annotations_count",
+    "assemblies_count",
+    "organisms_count",
+    "rank",
+    "coding_mean_count",
+    "non_coding_mean_count",
+    "pseudogene_mean_count"
+]
+
+# The jobs store a new TaxonTreeVersion after each write to the taxon nodes, the TTL only bounds writes made outside of them
+FLATTENED_TREE_CACHE_TTL = 600 #seconds
+_FLATTENED_TREE_CACHE = {"version": None, "expires_at": 0.0, "rows": None}
+
+def _get_flattened_tree_version(taxon_coll) -> tuple:
+    """
+    Cheap version token of the taxon collection: estimated count and the version stored by the last job that wrote the taxon nodes
+    """
+    tree_version = TaxonTreeVersion._get_collection().find_one({"name": TAXON_TREE_VERSION_NAME}, {"version": 1, "_id": 0})
+    return taxon_coll.estimated_document_count(), tree_version.get("version") if tree_version else None
+
+def _build_flattened_tree_rows(taxon_coll) -> list[list]:
+    # Single pass over the collection, the parent is read from the denormalized parent_taxid
+    rows = []
+    projection = {
+        "taxid": 1,
+        "parent_taxid": 1,
+        "scientific_name": 1,
+        "annotations_count": 1,
+        "assemblies_count": 1,
+        "organisms_count": 1,
+        "rank": 1,
+        "stats.genes.coding.count.mean": 1,
+        "stats.genes.non_coding.count.mean": 1,
+        "stats.genes.pseudogene.count.mean": 1,
+        "_id": 0
+    }
+    # skip cellular organism we use Eukaryota as root
+    for doc in taxon_coll.find({"taxid": {"$ne": CELLULAR_ORGANISMS_TAXID}}, projection).batch_size(5000):
+        parent_taxid = doc.get("parent_taxid")
+        genes = (doc.get("stats") or {}).get("genes") or {}
+        rows.append([
+            doc["taxid"],
+            None if parent_taxid == CELLULAR_ORGANISMS_TAXID else parent_taxid,
+            doc.get("scientific_name"),
+            doc.get("annotations_count", 0),
+            doc.get("assemblies_count", 0),
+            doc.get("organisms_count", 0),
+            doc.get("rank"),
+            _get_mean_count(genes, "coding"),
+            _get_mean_count(genes, "non_coding"),
+            _get_mean_count(genes, "pseudogene")
+        ])
+    return rows
+
+def _get_mean_count(genes: dict, category: str):
+    mean = ((genes.get(category) or {}).get("count") or {}).get("mean")
+    return 0 if mean is None else mean
+
+def get_flattened_tree_rows() -> list[list]:
+    """
+    Return the flattened tree rows, memoized until the taxon collection version changes or the cache expires
+    """
+    taxon_coll = TaxonNode._get_collection()
+    version = _get_flattened_tree_version(taxon_coll)
+    now = time.monotonic()
+    if _FLATTENED_TREE_CACHE["rows"] is not None and _FLATTENED_TREE_CACHE["version"] == version and now < _FLATTENED_TREE_CACHE["expires_at"]:
+        return _FLATTENED_TREE_CACHE["rows"]
+    rows = _build_flattened_tree_rows(taxon_coll)
+    _FLATTENED_TREE_CACHE.update(version=version, expires_at=now + FLATTENED_TREE_CACHE_TTL, rows=rows)
+    return rows
+
 def get_flattened_tree(format: str = "json"):
     """
     Returns flattened taxonomy tree.
     - format='json' (default): JSON with fields + rows (list of lists).
     - format='tsv': streaming TSV response (lower memory, streamed).
     """
-    taxon_coll = TaxonNode._get_collection()
-
-    # Build parent mapping - stream cursor (no list conversion)
-    parent_by_child = {}
-    # skip cellular organism we use Eukaryota as root
-    for doc in taxon_coll.find({"taxid": {"$ne": "131567"}}, {"taxid": 1, "children": 1}):
-        parent_taxid = doc["taxid"]
-        for child_taxid in doc.get("children", []):
-            parent_by_child[child_taxid] = parent_taxid
-
-    fields = [
-        "taxid",
-        "parent_taxid",
-        "scientific_name",
-        "annotations_count",
-        "assemblies_count",
-        "organisms_count",
-        "rank",
-        "coding_mean_count",
-        "non_coding_mean_count",
-        "pseudogene_mean_count"
-    ]
-
-    pipeline = [
-        {"$match": {"taxid": {"$ne": "131567"}}},
-        {"$project": {
-            "taxid": 1,
-            "scientific_name": 1,
-            "annotations_count": 1,
-            "assemblies_count": 1,
-            "organisms_count": 1,
-            "rank": 1,
-            "coding_mean_count": {"$ifNull": ["$stats.genes.coding.count.mean", 0]},
-            "non_coding_mean_count": {"$ifNull": ["$stats.genes.non_coding.count.mean", 0]},
-            "pseudogene_mean_count": {"$ifNull": ["$stats.genes.pseudogene.count.mean", 0]},
-            "_id": 0
-        }}
-    ]
+    rows = get_flattened_tree_rows()
 
     if format and format.lower() == "tsv":
-        TSV_BUFFER_SIZE = 5000
+        TSV_CHUNK_SIZE = 64 * 1024 #bytes of joined rows per yielded chunk
 
         def stream_tsv():
-            yield "\t".join(fields) + "\n"
+            yield "\t".join(FLATTENED_TREE_FIELDS) + "\n"
+            trans = _TSV_TRANS
             buffer: list[str] = []
-            for doc in taxon_coll.aggregate(pipeline):
-                taxid = doc["taxid"]
-                parent_taxid = parent_by_child.get(taxid)
-                row_values = [
-                    str(taxid),
-                    str(parent_taxid) if parent_taxid else "",
-                    str(doc.get("scientific_name", "")).replace("\t", " ").replace("\n", " "),
-                    str(doc.get("annotations_count", 0)),
-                    str(doc.get("assemblies_count", 0)),
-                    str(doc.get("organisms_count", 0)),
-                    str(doc.get("rank", "")).replace("\t", " ").replace("\n", " "),
-                    str(doc.get("coding_mean_count", 0)),
-                    str(doc.get("non_coding_mean_count", 0)),
-                    str(doc.get("pseudogene_mean_count", 0))
-                ]
-                buffer.append("\t".join(row_values) + "\n")
-                if len(buffer) >= TSV_BUFFER_SIZE:
+            buffered_size = 0
+            for row in rows:
+                row_values = ["" if value is None else str(value) for value in row]
+                #free text fields: scientific_name and rank
+                row_values[2] = row_values[2].translate(trans)
+                row_values[6] = row_values[6].translate(trans)
+                line = "\t".join(row_values) + "\n"
+                buffer.append(line)
+                buffered_size += len(line)
+                if buffered_size >= TSV_CHUNK_SIZE:
                     yield "".join(buffer)
                     buffer.clear()
+                    buffered_size = 0
             if buffer:
                 yield "".join(buffer)
 
@@ -127,23 +199,9 @@ def get_flattened_tree(format: str = "json"):
             headers={
                 "Content-Type": "text/tab-separated-values; charset=utf-8",
                 "X-Accel-Buffering": "no",
+                # proxies must not compress (and so re-buffer) the stream
+                "Cache-Control": "no-transform",
             }
         )
 
-    # JSON format (default): build rows list and return
-    rows = []
-    for doc in taxon_coll.aggregate(pipeline):
-        taxid = doc["taxid"]
-        rows.append([
-            taxid,
-            parent_by_child.get(taxid),
-            doc.get("scientific_name"),
-            doc.get("annotations_count", 0),
-            doc.get("assemblies_count", 0),
-            doc.get("organisms_count", 0),
-            doc.get("rank"),
-            doc.get("coding_mean_count", 0),
-            doc.get("non_coding_mean_count", 0),
-            doc.get("pseudogene_mean_count", 0)
-        ])
-    return {"fields": fields, "rows": rows}
+    return response_helper.stream_rows_json(FLATTENED_TREE_FIELDS, rows)